@@ -1,8 +1,34 @@
 # actions.py
 from __future__ import annotations
 
+import importlib.util
+import json
+import threading
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Annotated, Any, Callable, Dict, List, Optional, Sequence
+
+from cachetools import LRUCache, cached
+
+pydantic_spec = importlib.util.find_spec("pydantic")
+pydantic_available = pydantic_spec and pydantic_spec.loader is not None
+if pydantic_available:
+    from pydantic import AfterValidator, Field, TypeAdapter, ValidationError
+
+    # Range-checked in the compiled validator; out-of-range values fall back to from_dict clamping.
+    RepeatCount = Annotated[int, Field(ge=1, le=10)]
+    HoldMs = Annotated[int, Field(ge=0, le=2000)]
+else:
+    TypeAdapter = None
+    ValidationError = None
+    RepeatCount = int
+    HoldMs = int
+
+fastjsonschema_spec = importlib.util.find_spec("fastjsonschema")
+fastjsonschema_available = fastjsonschema_spec and fastjsonschema_spec.loader is not None
+if fastjsonschema_available:
+    import fastjsonschema
+else:
+    fastjsonschema = None
 
 
 SUPPORTED_ACTIONS = [
@@ -17,6 +43,18 @@ SUPPORTED_ACTIONS = [
     "FOCUS_WINDOW",
 ]
 
+# Flyweight table: parsed action names are swapped for these shared string objects.
+_ACTION_NAMES: Dict[str, str] = {name: name for name in SUPPORTED_ACTIONS}
+
+
+def canonical_action(name: str) -> str:
+    """Return the shared instance of a known action name (unknown names pass through)."""
+
+    return _ACTION_NAMES.get(name, name)
+
+
+ActionName = Annotated[str, AfterValidator(canonical_action)] if pydantic_available else str
+
 
 ACTION_SCHEMA = {
     "type": "object",
@@ -27,7 +65,7 @@ ACTION_SCHEMA = {
                 "type": "object",
                 "required": ["action", "confidence"],
                 "properties": {
-                    "action": {"enum": SUPPORTED_ACTIONS},
+                    "action": {"type": "string", "enum": SUPPORTED_ACTIONS},
                     "target": {
                         "type": "object",
                         "properties": {
@@ -62,8 +100,57 @@ ACTION_SCHEMA = {
     },
 }
 
+# Serialized once so prompts embed real JSON instead of re-stringifying the dict per call.
+ACTION_SCHEMA_JSON = json.dumps(ACTION_SCHEMA, separators=(",", ":"))
+
+_VALUE_CONSTRAINTS = frozenset({"minimum", "maximum", "enum"})
+
+
+def _structure_only(schema: Any) -> Any:
+    if isinstance(schema, dict):
+        return {key: _structure_only(value) for key, value in schema.items() if key not in _VALUE_CONSTRAINTS}
+    return schema
 
-@dataclass
+
+# What responses are validated against: ACTION_SCHEMA's shape and types, without its value
+# ranges and enums. ActionStep.from_dict clamps repeat/hold_ms and canonicalises action
+# names, so one out-of-range value must not discard an otherwise usable plan.
+ACTION_STRUCTURE_SCHEMA = {**_structure_only(ACTION_SCHEMA), "required": ["actions"]}
+
+# Compiled validators keyed by id(schema); compiling is far more expensive than validating.
+_COMPILED_VALIDATORS: Dict[int, Callable[[Any], Any]] = {}
+
+
+def compile_schema(schema: Dict[str, Any]) -> Optional[Callable[[Any], Any]]:
+    """Return a cached compiled validator for ``schema`` (None without fastjsonschema)."""
+
+    if not fastjsonschema:
+        return None
+    validator = _COMPILED_VALIDATORS.get(id(schema))
+    if validator is None:
+        validator = fastjsonschema.compile(schema)
+        _COMPILED_VALIDATORS[id(schema)] = validator
+    return validator
+
+
+def validate_action_response(response: Any) -> Optional[str]:
+    """Check a planner response's structure against ACTION_STRUCTURE_SCHEMA.
+
+    Returns ``None`` when the payload is valid (or no validator is installed),
+    otherwise the validation error message.
+    """
+
+    validator = compile_schema(ACTION_STRUCTURE_SCHEMA)
+    if validator is None:
+        return None
+    try:
+        validator(response)
+    except fastjsonschema.JsonSchemaException as exc:
+        return exc.message
+    return None
+
+
+@dataclass(slots=True)
 class ActionTarget:
     x: float
     y: float
@@ -71,9 +158,9 @@ class ActionTarget:
     height: Optional[float] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ActionStep:
-    action: str
+    action: ActionName
     confidence: float
     rationale: str = ""
     expected_outcome: str = ""
@@ -83,8 +170,8 @@ class ActionStep:
     scroll: Optional[Dict[str, float]] = None
     wait_seconds: float = 0.0
     # Hotkey helpers
-    repeat: int = 1
-    hold_ms: int = 0
+    repeat: RepeatCount = 1
+    hold_ms: HoldMs = 0
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> "ActionStep":
@@ -118,7 +205,7 @@ class ActionStep:
             hold_ms = 2000
 
         return cls(
-            action=data.get("action", "WAIT"),
+            action=canonical_action(data.get("action", "WAIT")),
             confidence=float(data.get("confidence", 0.0)),
             rationale=data.get("rationale", ""),
             expected_outcome=data.get("expected_outcome", ""),
@@ -141,14 +228,67 @@ class ActionStep:
         return f"{self.action}{target_desc} ({self.confidence:.2f})"
 
 
-def parse_actions(response: Dict[str, Any], min_confidence: float = 0.0) -> List[ActionStep]:
-    actions: List[ActionStep] = []
-    for raw in response.get("actions", []):
-        step = ActionStep.from_dict(raw)
-        if step.action != "WAIT" and step.confidence < min_confidence:
+# Built once at import so the pydantic-core schema is compiled a single time.
+_STEPS_ADAPTER = TypeAdapter(List[ActionStep]) if TypeAdapter else None
+
+
+def _validate_steps(raw_actions: Sequence[Dict[str, Any]]) -> List[ActionStep]:
+    """Validate a whole action array in one compiled call.
+
+    Well-formed planner output goes through the pydantic-core validator; anything
+    it rejects (missing fields, out-of-range hotkey values, odd types) is handed to
+    the lenient ``ActionStep.from_dict`` path so behaviour stays unchanged.
+    """
+
+    if _STEPS_ADAPTER is not None:
+        try:
+            return _STEPS_ADAPTER.validate_python(raw_actions)
+        except ValidationError:
+            pass
+    return [ActionStep.from_dict(raw) for raw in raw_actions]
+
+
+MAX_WAIT_SECONDS = 30.0
+
+
+def compact_waits(steps: List[ActionStep]) -> List[ActionStep]:
+    """Fuse runs of WAIT steps into one and drop zero-second WAITs.
+
+    Runs are summed (capped at the schema's 30 s) so the executor sleeps, logs and
+    updates state once. A plan made only of zero-second WAITs keeps one so the
+    loop still registers it as consumed and replans.
+    """
+
+    merged: List[ActionStep] = []
+    for step in steps:
+        if step.action == "WAIT" and merged and merged[-1].action == "WAIT":
+            merged[-1].wait_seconds = min(MAX_WAIT_SECONDS, merged[-1].wait_seconds + step.wait_seconds)
             continue
-        actions.append(step)
-    return actions
+        merged.append(step)
+    trimmed = [step for step in merged if step.action != "WAIT" or step.wait_seconds > 0]
+    return trimmed or merged
+
+
+def _above_confidence(raw: Any, min_confidence: float) -> bool:
+    # Malformed entries are kept so validation, not this pre-filter, decides their fate.
+    if not isinstance(raw, dict) or raw.get("action", "WAIT") == "WAIT":
+        return True
+    try:
+        return float(raw.get("confidence", 0.0)) >= min_confidence
+    except (TypeError, ValueError):
+        return True
+
+
+# Steps below this confidence are dropped by the loop rather than executed (WAITs are kept).
+MIN_STEP_CONFIDENCE = 0.55
+
+
+def parse_actions(response: Dict[str, Any], min_confidence: float = 0.0) -> List[ActionStep]:
+    raw_actions = response.get("actions", ())
+    if min_confidence > 0:
+        # Drop low-confidence steps before any ActionStep is built for them.
+        raw_actions = [raw for raw in raw_actions if _above_confidence(raw, min_confidence)]
+    return compact_waits(_validate_steps(raw_actions))
 
 
 DEFAULT_REFLECTION = {
@@ -162,3 +302,21 @@ DEFAULT_REFLECTION = {
         }
     ]
 }
+
+_FALLBACK_ACTION = DEFAULT_REFLECTION["actions"][0]
+# Shared result for a reason-less fallback; plans are treated as read-only downstream.
+_DEFAULT_FALLBACK = {"actions": [dict(_FALLBACK_ACTION)]}
+
+
+def fallback_plan(reason: str = "") -> Dict[str, Any]:
+    """The default WAIT plan, with ``reason`` as its rationale when given."""
+
+    if not reason:
+        return _DEFAULT_FALLBACK
+    return _reasoned_fallback(reason)
+
+
+# Planners in backoff return the same few reasons every tick; build each plan once.
+@cached(LRUCache(maxsize=16), lock=threading.Lock())
+def _reasoned_fallback(reason: str) -> Dict[str, Any]:
+    return {"actions": [{**_FALLBACK_ACTION, "rationale": reason}]}
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import time
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 from .actions import ActionStep, ActionTarget
 from .platform_agent import PlatformAdapter, Screenshot
@@ -11,6 +11,18 @@ class ActionExecutor:
     def __init__(self, adapter: PlatformAdapter) -> None:
         self.adapter = adapter
         self.last_capture_size: Optional[Tuple[int, int]] = None
+        # Action name -> handler, built once instead of walking an if/elif chain per step.
+        self._dispatch: Dict[str, Callable[[ActionStep, Optional[Tuple[int, int]]], None]] = {
+            "MOVE": self._do_move,
+            "CLICK": self._do_click,
+            "DOUBLE_CLICK": self._do_double_click,
+            "DRAG": self._do_drag,
+            "SCROLL": self._do_scroll,
+            "TYPE": self._do_type,
+            "KEYPRESS": self._do_keypress,
+            "WAIT": self._do_wait,
+            "FOCUS_WINDOW": self._do_focus_window,
+        }
 
     def _resolve_coords(self, target: ActionTarget, screenshot_size: Optional[Tuple[int, int]]) -> Tuple[int, int]:
         width, height = screenshot_size or self.adapter.screen_size()
@@ -36,28 +48,46 @@ class ActionExecutor:
         if step.target:
             target_coords = self._resolve_coords(step.target, screenshot_size)
 
-        if step.action == "MOVE" and target_coords:
-            self.adapter.move(*target_coords)
-        elif step.action == "CLICK" and target_coords:
-            self.adapter.click(*target_coords, clicks=1)
-        elif step.action == "DOUBLE_CLICK" and target_coords:
-            self.adapter.click(*target_coords, clicks=2)
-        elif step.action == "DRAG" and step.target:
-            end = target_coords or (0, 0)
+        handler = self._dispatch.get(step.action)
+        if handler:
+            handler(step, target_coords)
+
+        return step.summary()
+
+    def _do_move(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if coords:
+            self.adapter.move(*coords)
+
+    def _do_click(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if coords:
+            self.adapter.click(*coords, clicks=1)
+
+    def _do_double_click(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if coords:
+            self.adapter.click(*coords, clicks=2)
+
+    def _do_drag(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if step.target:
+            end = coords or (0, 0)
             screen_w, screen_h = self.adapter.screen_size()
             self.adapter.drag((screen_w // 2, screen_h // 2), end)
-        elif step.action == "SCROLL":
-            dx = int(step.scroll.get("dx", 0)) if step.scroll else 0
-            dy = int(step.scroll.get("dy", 0)) if step.scroll else 0
-            self.adapter.scroll(dx, dy)
-        elif step.action == "TYPE" and step.text:
+
+    def _do_scroll(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        dx = int(step.scroll.get("dx", 0)) if step.scroll else 0
+        dy = int(step.scroll.get("dy", 0)) if step.scroll else 0
+        self.adapter.scroll(dx, dy)
+
+    def _do_type(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if step.text:
             self.adapter.type_text(step.text)
-        elif step.action == "KEYPRESS" and step.keys:
+
+    def _do_keypress(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        if step.keys:
             self.adapter.keypress(step.keys, repeat=step.repeat, hold_ms=step.hold_ms)
-        elif step.action == "WAIT":
-            time.sleep(step.wait_seconds)
-        elif step.action == "FOCUS_WINDOW":
-            # Placeholder: focus logic depends on OS-specific integration.
-            time.sleep(0.05)
 
-        return step.summary()
+    def _do_wait(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        time.sleep(step.wait_seconds)
+
+    def _do_focus_window(self, step: ActionStep, coords: Optional[Tuple[int, int]]) -> None:
+        # Placeholder: focus logic depends on OS-specific integration.
+        time.sleep(0.05)
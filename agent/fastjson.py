@@ -0,0 +1,81 @@
+"""JSON helpers backed by orjson when available, falling back to the stdlib."""
+
+from __future__ import annotations
+
+import dataclasses
+import importlib.util
+import json
+from typing import Any, Optional
+
+orjson_spec = importlib.util.find_spec("orjson")
+orjson_available = orjson_spec and orjson_spec.loader is not None
+if orjson_available:
+    import orjson
+else:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both.
+JSONDecodeError = json.JSONDecodeError
+
+_DECODER = json.JSONDecoder()
+
+
+def _default(obj: Any) -> Any:
+    """Stdlib fallback for what orjson serializes natively: dataclasses and NumPy arrays."""
+
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        # orjson skips underscore-prefixed (private) fields; match it.
+        return {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj) if not f.name.startswith("_")}
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def loads(data: str | bytes) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Compact JSON text (non-ASCII kept as-is)."""
+
+    if orjson:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps_bytes(obj: Any, newline: bool = False, indent: bool = False) -> bytes:
+    """UTF-8 JSON as bytes: compact, or two-space ``indent`` for files people read.
+
+    ``newline`` terminates the output with ``\\n`` (for JSONL). Dataclass instances
+    (public fields only) and NumPy arrays are serialized directly, without an
+    intermediate dict or list.
+    """
+
+    if orjson:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        option |= (orjson.OPT_APPEND_NEWLINE if newline else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    if indent:
+        text = json.dumps(obj, ensure_ascii=False, indent=2, default=_default)
+    else:
+        text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default)
+    return (text + "\n" if newline else text).encode("utf-8")
+
+
+def first_object(text: str) -> Optional[Any]:
+    """Decode the first complete ``{...}`` object embedded in ``text``.
+
+    Each candidate ``{`` is handed to ``raw_decode``, which stops at the end of
+    the object, so surrounding prose or trailing garbage is ignored and no
+    backtracking regex runs over the whole response.
+    """
+
+    start = text.find("{")
+    while start != -1:
+        try:
+            return _DECODER.raw_decode(text, start)[0]
+        except json.JSONDecodeError:
+            start = text.find("{", start + 1)
+    return None
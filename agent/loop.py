@@ -1,22 +1,32 @@
 from __future__ import annotations
 
+import copy
+import logging
+import os
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
-import hashlib
+from cachetools import LRUCache
 
-from .actions import ActionStep, parse_actions
+from .actions import MIN_STEP_CONFIDENCE, ActionStep, parse_actions
 from .controller import ActionExecutor
 from .planners.factory import create_planner
-from .platform_agent import PlatformAdapter, Screenshot, default_adapter
+from .platform_agent import SCREENSHOT_MIME_TYPES, PlatformAdapter, Screenshot, b64encode_str, default_adapter
 from .state import StateManager, utc_now
-from .storage import log_action, snapshot_state
+from .storage import StorageWriter
+
+logger = logging.getLogger(__name__)
 
 
 class AgentOrchestrator:
+    planner_max_side = 512
+    # Per-tick snapshots are msgpack; every Nth one is JSON so there is always a readable recent copy.
+    json_snapshot_every = 30
+
     def __init__(self, state_path: Path, data_dir: Path, adapter: Optional[PlatformAdapter] = None) -> None:
         self.state_manager = StateManager(state_path)
         self.planner = create_planner()
@@ -25,23 +35,47 @@ class AgentOrchestrator:
         self.data_dir = data_dir
         self.log_path = data_dir / "actions.log"
         self.snapshot_dir = data_dir / "snapshots"
-        self.running = False
+        # VLMs don't need lossless pixels; JPEG encodes faster and is several times smaller than PNG.
+        screenshot_format = os.getenv("SCREENSHOT_FORMAT", "JPEG").upper()
+        self.screenshot_format = screenshot_format if screenshot_format in SCREENSHOT_MIME_TYPES else "JPEG"
+        self.screenshot_mime = SCREENSHOT_MIME_TYPES[self.screenshot_format]
+        try:
+            self.planner_max_side = int(os.getenv("SCREENSHOT_MAX_SIDE", str(self.planner_max_side)))
+        except ValueError:
+            logger.warning("Ignoring non-integer SCREENSHOT_MAX_SIDE; using %d.", self.planner_max_side)
+        # Each run gets a fresh event so a slow-to-exit previous thread can't be revived by start().
+        self._stop_event = threading.Event()
+        self._stop_event.set()
         self.thread: Optional[threading.Thread] = None
         self.lock = threading.Lock()
-        self.planning_lock = threading.Lock()
-        self.planning_inflight = False
+        # One shared pool: a worker for the (single in-flight) planner call and one for
+        # storage flushes, so neither subsystem needs a dedicated thread of its own.
+        self._pool: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agent-worker")
+        self.writer = StorageWriter(executor=self._pool)
+        self._plan_future: Optional[Future[Dict[str, Any]]] = None
+        self._plan_future_key: Optional[str] = None
         self.last_screenshot: Optional[Screenshot] = None
         self.last_vision_time: Optional[float] = None
+        self._prepared_screenshot: Optional[Tuple[Screenshot, bytes, str, Optional[str], str]] = None
         self.pending_actions: list[ActionStep] = []
+        # Key of the plan whose actions are currently queued/executing (logged with each action).
         self.cached_plan_key: Optional[str] = None
-        self.cached_plan_response: Optional[dict[str, Any]] = None
-        self.cached_plan_consumed: bool = False
+        # Plans are kept per context (screen content + goal/task/mode) so a UI that alternates
+        # between a few states reuses them. Each entry is replayed at most once, and never for
+        # the context it was just executed on, so old clicks can't loop.
+        self._plan_cache: LRUCache[str, Dict[str, Any]] = LRUCache(maxsize=64)
+        self._consumed_plan_key: Optional[str] = None
         self.last_logged: Optional[tuple[str, str]] = None
+        self._snapshot_count = 0
 
     @property
     def state(self):
         return self.state_manager.state
 
+    @property
+    def running(self) -> bool:
+        return not self._stop_event.is_set()
+
     def start(self, mode: str, goal: str, active_start: Optional[str], active_stop: Optional[str]) -> None:
         with self.lock:
             if self.running:
@@ -49,35 +83,47 @@ class AgentOrchestrator:
             self.state_manager.set_goal(goal, mode)
             self.state_manager.set_active_window(active_start, active_stop)
             self.state_manager.mark_active()
-            self.running = True
-            self.thread = threading.Thread(target=self._run_loop, daemon=True)
+            if self._pool is None:
+                # The previous run shut its pool down on exit.
+                self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agent-worker")
+                self.writer.set_executor(self._pool)
+            self._stop_event = threading.Event()
+            self.thread = threading.Thread(target=self._run_loop, args=(self._stop_event,), daemon=True)
             self.thread.start()
             print("AGENT THREAD STARTED", flush=True)
 
 
     def stop(self) -> None:
         with self.lock:
-            self.running = False
+            self._stop_event.set()
             self.state_manager.mark_stopped()
         if self.thread:
             self.thread.join(timeout=1.0)
+        self.writer.flush()
 
     def _in_active_window(self) -> bool:
-        if not self.state.active_window_start or not self.state.active_window_stop:
+        window = self.state_manager.active_window_hm
+        if window is None:
             return True
+        start, stop = window
         now = datetime.now()
-        start = datetime.strptime(self.state.active_window_start, "%H:%M").time()
-        stop = datetime.strptime(self.state.active_window_stop, "%H:%M").time()
-        return start <= now.time() <= stop
+        return start <= (now.hour, now.minute) <= stop
 
     def _reflect(self) -> None:
         summary = "Sleeping and reflecting on recent actions."
         self.state.decay_emotions()
-        self.state_manager.update_monologue(summary)
-        snapshot_state(self.snapshot_dir, self.state)
+        self.state.update_monologue(summary)
+        # Saved directly: the monologue repeats every sleep tick, but the emotions decayed.
+        self.state_manager.save()
+        self._snapshot()
+
+    def _snapshot(self) -> None:
+        fmt = "json" if self._snapshot_count % self.json_snapshot_every == 0 else "msgpack"
+        self._snapshot_count += 1
+        self.writer.snapshot_state(self.snapshot_dir, self.state, fmt=fmt)
 
     def _maybe_capture(self) -> Optional[Screenshot]:
-        now = time.time()
+        now = time.monotonic()
         if self.last_vision_time and now - self.last_vision_time < 5:
             return None
         screenshot = self.adapter.capture()
@@ -89,95 +135,119 @@ class AgentOrchestrator:
         if not screenshot:
             return None
         try:
-            # Hash raw pixel bytes to avoid recompressing base64 for cache keys.
-            digest = hashlib.sha256(screenshot.image.tobytes()).hexdigest()
+            # Hash a downsampled thumbnail rather than copying the full framebuffer.
+            digest = screenshot.content_key()
             dpi = getattr(screenshot, "dpi", (96.0, 96.0))
             return f"{digest}:{screenshot.width}x{screenshot.height}:dpi={dpi}"
         except Exception:
             return None
 
-    def _run_loop(self) -> None:
-        planner_max_side = 512
-        while True:
-            with self.lock:
-                if not self.running:
-                    break
+    def _prepare_screenshot(
+        self, screenshot: Optional[Screenshot]
+    ) -> Tuple[Optional[bytes], Optional[str], Optional[str], Optional[str]]:
+        """Return ``(encoded bytes, base64, cache key, meta)`` for the planner.
 
+        The loop reuses ``last_screenshot`` between captures, so the downscale +
+        PNG/base64 encode + hashing is done once per captured frame, not per tick.
+        """
+
+        if not screenshot:
+            return None, None, None, None
+        cached = self._prepared_screenshot
+        if cached and cached[0] is screenshot:
+            return cached[1:]
+
+        downscaled = screenshot.downscale(self.planner_max_side)
+        screenshot_bytes = downscaled.to_bytes(fmt=self.screenshot_format)
+        screenshot_b64 = b64encode_str(screenshot_bytes)
+        if (downscaled.width, downscaled.height) != (screenshot.width, screenshot.height):
+            scaled_meta = f"{screenshot.width}x{screenshot.height} -> {downscaled.width}x{downscaled.height}"
+        else:
+            scaled_meta = f"{downscaled.width}x{downscaled.height}"
+        screenshot_key = self._screenshot_key(screenshot)
+        dpi = getattr(screenshot, "dpi", (96.0, 96.0))
+        screenshot_meta = f"{screenshot.width}x{screenshot.height} @ {dpi} dpi (scaled to {scaled_meta})"
+
+        self._prepared_screenshot = (screenshot, screenshot_bytes, screenshot_b64, screenshot_key, screenshot_meta)
+        return screenshot_bytes, screenshot_b64, screenshot_key, screenshot_meta
+
+    def _run_loop(self, stop_event: threading.Event) -> None:
+        try:
+            self._loop_until(stop_event)
+        finally:
+            self._end_run(stop_event)
+
+    def _end_run(self, stop_event: threading.Event) -> None:
+        """Drop the run's in-flight plan and queued actions and shut its worker pool down."""
+
+        with self.lock:
+            if self._stop_event is not stop_event:
+                # start() already began a newer run, which owns the pool and plan state now.
+                return
+            if self._plan_future is not None:
+                self._plan_future.cancel()
+            self._plan_future = None
+            self._plan_future_key = None
+            self.pending_actions.clear()
+            if self._pool is not None:
+                # No cancel_futures: a queued storage flush must still run (and clear its flag).
+                self._pool.shutdown(wait=False)
+                self._pool = None
+                self.writer.set_executor(None)
+
+    def _loop_until(self, stop_event: threading.Event) -> None:
+        while not stop_event.is_set():
             if not self._in_active_window():
                 self.state_manager.mark_sleeping()
                 self._reflect()
-                time.sleep(5)
+                stop_event.wait(5)
                 continue
 
             self.state_manager.mark_active()
             screenshot = self._maybe_capture()
             screenshot_to_use = screenshot or self.last_screenshot
-            screenshot_b64 = None
-            scaled_meta: Optional[str] = None
-            if screenshot_to_use:
-                downscaled = screenshot_to_use.downscale(planner_max_side)
-                screenshot_b64 = downscaled.to_base64()
-                if (downscaled.width, downscaled.height) != (screenshot_to_use.width, screenshot_to_use.height):
-                    scaled_meta = (
-                        f"{screenshot_to_use.width}x{screenshot_to_use.height} -> "
-                        f"{downscaled.width}x{downscaled.height}"
-                    )
-                else:
-                    scaled_meta = f"{downscaled.width}x{downscaled.height}"
-            screenshot_key = self._screenshot_key(screenshot_to_use)
-            screenshot_meta = None
-            if screenshot_to_use:
-                dpi = getattr(screenshot_to_use, "dpi", (96.0, 96.0))
-                base_meta = f"{screenshot_to_use.width}x{screenshot_to_use.height} @ {dpi} dpi"
-                if scaled_meta:
-                    screenshot_meta = f"{base_meta} (scaled to {scaled_meta})"
-                else:
-                    screenshot_meta = base_meta
+            screenshot_bytes, screenshot_b64, screenshot_key, screenshot_meta = self._prepare_screenshot(screenshot_to_use)
 
             sleep_after_loop = 0.5
 
             if not self.pending_actions:
-                perception_marker = self.last_vision_time or 0
+                # screenshot_key is a content digest, so an unchanged screen maps to the same key
+                # across captures.
                 context_key = (
-                    f"{screenshot_key}:{perception_marker}:{self.state.current_goal}:"
+                    f"{screenshot_key}:{self.state.current_goal}:"
                     f"{self.state.current_task}:{self.state.current_mode}"
                 )
                 plan_response: Optional[Dict[str, Any]] = None
 
-                if self.cached_plan_key == context_key:
-                    if self.cached_plan_response is not None and not self.cached_plan_consumed:
-                        plan_response = self.cached_plan_response
-                    else:
-                        sleep_after_loop = 0.2
+                # Popped: an entry is replayed at most once. A plan just executed for this same
+                # context is discarded rather than replayed, and the planner is asked again.
+                cached_response = self._plan_cache.pop(context_key, None)
+                if cached_response is not None and context_key != self._consumed_plan_key:
+                    plan_response = cached_response
+                    self.cached_plan_key = context_key
                 else:
-                    should_call_planner = False
-                    with self.planning_lock:
-                        if self.planning_inflight:
-                            sleep_after_loop = 0.2
-                        else:
-                            self.planning_inflight = True
-                            should_call_planner = True
-
-                    if should_call_planner:
-                        try:
-                            print("CALLING PLANNER", flush=True)
-                            plan_response = self.planner.plan(
-                                self.state,
-                                screenshot_b64,
-                                metadata={"screenshot_key": screenshot_key, "screenshot_meta": screenshot_meta},
-                            )
-                            self.cached_plan_key = context_key
-                            self.cached_plan_response = plan_response
-                            self.cached_plan_consumed = False
-                        finally:
-                            with self.planning_lock:
-                                self.planning_inflight = False
+                    if self._plan_future is None:
+                        print("CALLING PLANNER", flush=True)
+                        self._plan_future_key = context_key
+                        # Hand the worker a copy so it reads a consistent state while the loop mutates ours.
+                        self._plan_future = self._pool.submit(
+                            self.planner.plan,
+                            copy.copy(self.state),
+                            screenshot_b64,
+                            metadata={
+                                "screenshot_key": screenshot_key,
+                                "screenshot_meta": screenshot_meta,
+                                "screenshot_mime": self.screenshot_mime,
+                                # Raw encoded image for planners that upload bytes rather than base64.
+                                "screenshot_bytes": screenshot_bytes,
+                            },
+                        )
+                    if self._plan_future.done():
+                        plan_response = self._take_plan_result(context_key)
 
                 if plan_response is not None:
-                    actions = parse_actions(plan_response, min_confidence=0.55)
-                    # Allow WAIT even if low confidence to avoid churn.
-                    filtered_actions = [a for a in actions if a.action == "WAIT" or a.confidence >= 0.55]
-                    self.pending_actions.extend(filtered_actions)
+                    # parse_actions keeps WAIT even if low confidence to avoid churn.
+                    self.pending_actions.extend(parse_actions(plan_response, min_confidence=MIN_STEP_CONFIDENCE))
                 else:
                     sleep_after_loop = 0.2
 
@@ -191,19 +261,36 @@ class AgentOrchestrator:
                     self.state_manager.update_after_action(summary)
                     plan_payload = {"plan_key": self.cached_plan_key}
                     if not self.last_logged or self.last_logged != (summary, self.cached_plan_key or ""):
-                        log_action(self.log_path, summary, plan_payload)
+                        self.writer.log_action(self.log_path, summary, plan_payload)
                         self.last_logged = (summary, self.cached_plan_key or "")
 
                 # If the last action was a WAIT, reduce extra sleep; otherwise keep small cushion.
                 if actions_to_run and actions_to_run[-1].action == "WAIT":
                     sleep_after_loop = 0.1
-                self.cached_plan_consumed = True
+                self._consumed_plan_key = self.cached_plan_key
                 self.last_vision_time = None
 
             self.state.stimulate_emotions(0.02)
             self.state_manager.save()
-            snapshot_state(self.snapshot_dir, self.state)
-            time.sleep(sleep_after_loop)
+            self._snapshot()
+            stop_event.wait(sleep_after_loop)
+
+    def _take_plan_result(self, context_key: str) -> Optional[Dict[str, Any]]:
+        future, key = self._plan_future, self._plan_future_key
+        self._plan_future = None
+        self._plan_future_key = None
+        try:
+            plan_response = future.result()
+        except Exception:  # noqa: BLE001
+            logger.exception("Planner call raised; will replan on the next tick.")
+            return None
+        if key != context_key:
+            # The screen, goal or task changed while the planner ran; its plan targets a
+            # context that is gone, so ask again for the current one.
+            return None
+        self.cached_plan_key = key
+        self._plan_cache[key] = plan_response
+        return plan_response
 
     def get_state(self) -> Dict[str, Any]:
         return self.state.to_dict()
@@ -1,10 +1,41 @@
 from __future__ import annotations
 
+import re
 from typing import Any, Dict, Optional, Protocol
 
 from agent.state import AgentState
 
 
+IDLE_SKIP_SECONDS = 1.0
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+
+def nothing_to_plan(state: AgentState, screenshot_b64: Optional[str]) -> bool:
+    """True when a planner call could only produce a WAIT.
+
+    That is: no screenshot to look at, no goal to pursue, and an action was
+    taken less than ``IDLE_SKIP_SECONDS`` ago.
+    """
+
+    if screenshot_b64 or state.current_goal or not state.last_action:
+        return False
+    elapsed = state.time_since_last_action()
+    return elapsed is not None and elapsed < IDLE_SKIP_SECONDS
+
+
+def strip_code_fence(text: str) -> str:
+    """Trim whitespace and a surrounding ```json fence from a model reply."""
+
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = _CODE_FENCE.sub("", cleaned)
+    return cleaned
+
+
 class Planner(Protocol):
     def plan(self, state: AgentState, screenshot_b64: Optional[str], metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         ...
+
+    async def aplan(self, state: AgentState, screenshot_b64: Optional[str], metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        ...
@@ -1,28 +1,53 @@
 # gemini_client.py
 from __future__ import annotations
 
-import importlib.util
 import inspect
 import logging
 import os
-import re
 import time
-from typing import Any, Dict, Optional
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Union
 
-from agent.actions import ACTION_SCHEMA, DEFAULT_REFLECTION
-from agent.state import AgentState
+from agent import fastjson
+from agent.actions import ACTION_SCHEMA, ACTION_SCHEMA_JSON, fallback_plan, validate_action_response
+from agent.planners.base import nothing_to_plan, strip_code_fence
+from agent.planners.semantic_cache import SemanticCache
+from agent.state import AgentState, format_floats
 
 
 logger = logging.getLogger(__name__)
 
-genai_spec = importlib.util.find_spec("google.generativeai")
-genai_available = genai_spec and genai_spec.loader is not None
-if genai_available:
-    import google.generativeai as genai
-    from google.generativeai.types import GenerationConfig
-else:
-    genai = None
-    GenerationConfig = None
+# Imported on first GeminiPlanner construction: the SDK pulls in gRPC/protobuf, which
+# setups using another backend shouldn't pay for.
+genai: Optional[Any] = None
+GenerationConfig: Optional[Any] = None
+_GENERATION_CONFIG_PARAMS: Optional[frozenset[str]] = None
+_genai_import_attempted = False
+
+
+def _generation_config_params() -> Optional[frozenset[str]]:
+    if not GenerationConfig:
+        return None
+    try:
+        return frozenset(inspect.signature(GenerationConfig).parameters)
+    except (TypeError, ValueError):  # pragma: no cover - defensive
+        logger.debug("Could not inspect GenerationConfig signature; using defaults.")
+        return None
+
+
+def _import_genai() -> bool:
+    global genai, GenerationConfig, _GENERATION_CONFIG_PARAMS, _genai_import_attempted
+    if not _genai_import_attempted:
+        _genai_import_attempted = True
+        try:
+            import google.generativeai as sdk
+            from google.generativeai.types import GenerationConfig as SdkGenerationConfig
+        except ImportError:
+            return False
+        genai, GenerationConfig = sdk, SdkGenerationConfig
+        # The SDK signature can't change within a process, so it is inspected once.
+        _GENERATION_CONFIG_PARAMS = _generation_config_params()
+    return genai is not None
 
 
 PROMPT_TEMPLATE = """
@@ -42,24 +67,28 @@ Speed & reliability:
 
 Keep actions concise and deterministic. Return actions in execution order.
 
-Agent mode: {mode}
-Current goal: {goal}
-Current task: {task}
-Last action: {last_action}
-Last action time (UTC): {last_action_time}
-Inner monologue summary: {monologue}
-Emotion vector (10 floats 0..1): {emotions}
-Active window: {active_start} -> {active_stop}
-Agent status: {status}
-Time since last action (s): {tsla}
-Screenshot provided this request: {has_screenshot}
-Screenshot meta (width x height @ dpi): {screenshot_meta}
-
 Action schema (JSON Schema): {schema}
+
 """
 
+# Everything above the per-tick state is constant, so it is rendered once at import;
+# plan() only formats the short dynamic tail and sends it as a separate part.
+PROMPT_PREFIX = PROMPT_TEMPLATE.format(schema=ACTION_SCHEMA_JSON)
+
+
+@dataclass
+class _PlanRequest:
+    parts: list[Any]
+    embedding: Optional[Any]
+    scope: Optional[str]
+
 
 class GeminiPlanner:
+    # Skip the API call on ticks that can only yield a WAIT (see nothing_to_plan).
+    enable_fast_path = True
+    _generation_config: Optional[Any] = None
+    _generation_config_built = False
+
     def __init__(
         self,
         model: str = "gemini-2.5-flash",
@@ -71,8 +100,11 @@ class GeminiPlanner:
         self.client: Optional[Any] = None
         self.unavailable_reason: Optional[str] = None
         self.next_allowed_time: float = 0.0
+        self._last_state_key: Optional[tuple[Any, ...]] = None
+        self._last_state_block: str = ""
+        self.semantic_cache: Optional[SemanticCache] = None
 
-        if not genai:
+        if not _import_genai():
             self.unavailable_reason = "google.generativeai is not installed."
             return
 
@@ -89,56 +121,142 @@ class GeminiPlanner:
                 model_kwargs["generation_config"] = generation_config
 
             self.client = genai.GenerativeModel(self.model_name, **model_kwargs)
+            self.semantic_cache = SemanticCache.from_env()
         except Exception as exc:  # noqa: BLE001
             self.unavailable_reason = f"Gemini client init failed: {exc}"
             logger.exception(self.unavailable_reason)
 
     def plan(self, state: AgentState, screenshot_b64: Optional[str], metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        request = self._prepare_request(state, screenshot_b64, metadata)
+        if isinstance(request, dict):
+            return request
+        try:
+            response = self.client.generate_content(request.parts, request_options={"timeout": 120})
+        except Exception as exc:  # noqa: BLE001
+            return self._failed(exc)
+        return self._finish(request, response)
+
+    async def aplan(
+        self,
+        state: AgentState,
+        screenshot_b64: Optional[str],
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Async variant of :meth:`plan`; several calls can be overlapped with ``asyncio.gather``."""
+
+        request = self._prepare_request(state, screenshot_b64, metadata)
+        if isinstance(request, dict):
+            return request
+        try:
+            response = await self.client.generate_content_async(request.parts, request_options={"timeout": 120})
+        except Exception as exc:  # noqa: BLE001
+            return self._failed(exc)
+        return self._finish(request, response)
+
+    def _prepare_request(
+        self,
+        state: AgentState,
+        screenshot_b64: Optional[str],
+        metadata: Optional[Dict[str, Any]],
+    ) -> Union[Dict[str, Any], _PlanRequest]:
+        """Build the request parts, or return a final result (fallback or cache hit) directly."""
+
         if not self.client:
             logger.warning("Falling back to default reflection: %s", self.unavailable_reason)
             return self._fallback(self.unavailable_reason or "Gemini client unavailable.")
 
-        now = time.time()
+        now = time.monotonic()
         if self.next_allowed_time and now < self.next_allowed_time:
             wait_for = max(0.0, self.next_allowed_time - now)
             return self._fallback(f"Rate limited; retry after {wait_for:.1f}s.")
 
+        if self.enable_fast_path and nothing_to_plan(state, screenshot_b64):
+            return self._fallback("No new observations; WAIT.")
+
         screenshot_meta = metadata.get("screenshot_meta") if metadata else None
-        prompt = PROMPT_TEMPLATE.format(
-            mode=state.current_mode,
-            goal=state.current_goal or "<none>",
-            task=state.current_task or "<none>",
-            last_action=state.last_action or "<none>",
-            last_action_time=state.last_action_time or "<never>",
-            monologue=state.inner_monologue_summary or "",
-            emotions=state.emotion_vector,
-            active_start=state.active_window_start or "<unset>",
-            active_stop=state.active_window_stop or "<unset>",
-            status=state.agent_status,
-            tsla=state.time_since_last_action(),
-            has_screenshot=bool(screenshot_b64),
-            screenshot_meta=screenshot_meta or "<unknown>",
-            schema=ACTION_SCHEMA,
+        state_text = (
+            f"{self._state_block(state)}"
+            f"Time since last action (s): {state.time_since_last_action()}\n"
+            f"Screenshot provided this request: {bool(screenshot_b64)}\n"
+            f"Screenshot meta (width x height @ dpi): {screenshot_meta or '<unknown>'}\n"
         )
 
-        parts: list[Any] = [prompt]
+        # Only the per-tick state is embedded; the static prefix is shared by every prompt.
+        embedding = None
+        scope = metadata.get("screenshot_key") if metadata else None
+        if self.semantic_cache is not None:
+            embedding = self.semantic_cache.embed(state_text)
+            cached = self.semantic_cache.get(embedding, scope)
+            if cached is not None:
+                logger.debug("Semantic cache hit; skipping Gemini call.")
+                return cached
+
+        # The static prefix goes in its own part so it stays byte-identical across calls
+        # and can be served from Gemini's implicit prefix cache.
+        parts: list[Any] = [PROMPT_PREFIX, state_text]
         if screenshot_b64:
+            metadata = metadata or {}
+            # Blob.data is a bytes field: a base64 str would be decoded back to bytes by the
+            # SDK, so the loop's raw encoded image is handed over directly when present.
+            image_bytes = metadata.get("screenshot_bytes")
             parts.append(
                 {
-                    "mime_type": "image/png",
-                    "data": screenshot_b64,
+                    "mime_type": metadata.get("screenshot_mime", "image/png"),
+                    "data": image_bytes if image_bytes is not None else screenshot_b64,
                 }
             )
 
+        return _PlanRequest(parts, embedding, scope)
+
+    def _finish(self, request: _PlanRequest, response: Any) -> Dict[str, Any]:
         try:
-            response = self.client.generate_content(parts, request_options={"timeout": 120})
             text = self._extract_text(response)
             self.next_allowed_time = 0.0
-            return self._safe_json(text)
+            result = self._safe_json(text)
+            if request.embedding is not None:
+                self.semantic_cache.put(request.embedding, request.scope, result)
+            return result
         except Exception as exc:  # noqa: BLE001
-            logger.exception("Gemini planning failed; returning fallback WAIT action.")
-            self.next_allowed_time = time.time() + self._backoff_seconds(exc)
-            return self._fallback(f"Gemini planning failed: {exc}")
+            return self._failed(exc)
+
+    def _failed(self, exc: Exception) -> Dict[str, Any]:
+        logger.exception("Gemini planning failed; returning fallback WAIT action.")
+        self.next_allowed_time = time.monotonic() + self._backoff_seconds(exc)
+        return self._fallback(f"Gemini planning failed: {exc}")
+
+    def _state_block(self, state: AgentState) -> str:
+        """Render the slow-changing state lines, reusing the last rendering while they are unchanged.
+
+        Only the time-since-last-action and screenshot lines differ on most ticks,
+        so those are formatted fresh by the caller.
+        """
+
+        key = (
+            state.current_mode,
+            state.current_goal,
+            state.current_task,
+            state.last_action,
+            state.last_action_time,
+            state.inner_monologue_summary,
+            tuple(state.emotion_vector),
+            state.active_window_start,
+            state.active_window_stop,
+            state.agent_status,
+        )
+        if key != self._last_state_key:
+            self._last_state_key = key
+            self._last_state_block = (
+                f"Agent mode: {state.current_mode}\n"
+                f"Current goal: {state.current_goal or '<none>'}\n"
+                f"Current task: {state.current_task or '<none>'}\n"
+                f"Last action: {state.last_action or '<none>'}\n"
+                f"Last action time (UTC): {state.last_action_time or '<never>'}\n"
+                f"Inner monologue summary: {state.inner_monologue_summary or ''}\n"
+                f"Emotion vector (10 floats 0..1): {format_floats(state.emotion_vector)}\n"
+                f"Active window: {state.active_window_start or '<unset>'} -> {state.active_window_stop or '<unset>'}\n"
+                f"Agent status: {state.agent_status}\n"
+            )
+        return self._last_state_block
 
     def _extract_text(self, response: Any) -> str:
         """Extract the model text response from a GenerateContentResponse.
@@ -168,40 +286,36 @@ class GeminiPlanner:
         return ""
 
     def _safe_json(self, text: str) -> Dict[str, Any]:
-        import json
-
-        cleaned = (text or "").strip()
+        cleaned = strip_code_fence(text or "")
         if not cleaned:
             logger.warning("Gemini response was empty; returning WAIT fallback.")
             return self._fallback("Planner returned empty response.")
 
-        if cleaned.startswith("```"):
-            cleaned = re.sub(r"^```(?:json)?\n", "", cleaned)
-            cleaned = re.sub(r"```\s*$", "", cleaned)
-
         # Try direct parse first
         try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
+            return self._validated(fastjson.loads(cleaned))
+        except fastjson.JSONDecodeError:
             pass
 
-        # Minimal salvage: extract the first JSON object if the model added preamble text
-        match = re.search(r"\{.*\}", cleaned, flags=re.DOTALL)
-        if match:
-            candidate = match.group(0).strip()
-            try:
-                return json.loads(candidate)
-            except json.JSONDecodeError as exc:
-                logger.warning("Extracted JSON still invalid: %s", exc)
+        # Minimal salvage: extract the first JSON object if the model added preamble text.
+        # Only a full plan counts: in a truncated reply the first complete object can be an
+        # inner action, which must not pass for an (empty) plan.
+        payload = fastjson.first_object(cleaned)
+        if isinstance(payload, dict) and "actions" in payload:
+            return self._validated(payload)
 
         logger.warning("Gemini response was not valid JSON; returning WAIT fallback.")
         return self._fallback("Planner returned non-JSON response.")
 
+    def _validated(self, payload: Any) -> Dict[str, Any]:
+        error = validate_action_response(payload)
+        if error:
+            logger.warning("Gemini response did not match the action schema: %s", error)
+            return self._fallback("Planner returned a response outside the action schema.")
+        return payload
+
     def _fallback(self, reason: str) -> Dict[str, Any]:
-        action = dict(DEFAULT_REFLECTION["actions"][0])
-        if reason:
-            action["rationale"] = reason
-        return {"actions": [action]}
+        return fallback_plan(reason)
 
     def _build_generation_config(self) -> Optional[Any]:
         """Build a GenerationConfig that is compatible with installed SDK.
@@ -214,21 +328,24 @@ class GeminiPlanner:
 
         if not GenerationConfig:
             return None
+        # ACTION_SCHEMA is a module constant, so every planner instance can share one config.
+        cls = type(self)
+        if cls._generation_config_built:
+            return cls._generation_config
+
+        cls._generation_config = self._make_generation_config()
+        cls._generation_config_built = True
+        return cls._generation_config
 
+    def _make_generation_config(self) -> Optional[Any]:
         desired = {
             "response_mime_type": "application/json",
             "response_schema": ACTION_SCHEMA,
         }
 
-        try:
-            signature = inspect.signature(GenerationConfig)
-        except (TypeError, ValueError):  # pragma: no cover - defensive
-            logger.debug("Could not inspect GenerationConfig signature; using defaults.")
-            signature = None
-
         supported_kwargs: Dict[str, Any] = {}
         for name, value in desired.items():
-            if signature and name not in signature.parameters:
+            if _GENERATION_CONFIG_PARAMS is not None and name not in _GENERATION_CONFIG_PARAMS:
                 logger.debug("GenerationConfig missing %s; skipping.", name)
                 continue
             supported_kwargs[name] = value
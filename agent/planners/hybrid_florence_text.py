@@ -1,21 +1,32 @@
 from __future__ import annotations
 
-import base64
-import json
+import asyncio
+import atexit
+import binascii
+import gzip
 import logging
 import os
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, Optional
 
 import requests
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from agent.actions import ACTION_SCHEMA, DEFAULT_REFLECTION
-from agent.state import AgentState
+from agent import fastjson
+from agent.actions import ACTION_SCHEMA_JSON, fallback_plan
+from agent.planners.base import nothing_to_plan, strip_code_fence
+from agent.platform_agent import fingerprint, strip_data_uri
+from agent.planners.semantic_cache import SemanticCache
+from agent.state import AgentState, format_floats
 
 logger = logging.getLogger(__name__)
 
 
-PROMPT_TEMPLATE = """
+PROMPT_HEADER = """
 You are an autonomous desktop agent. You control mouse and keyboard. Respond ONLY with JSON following the provided schema.
 - Use normalized coordinates (0..1) relative to the latest screenshot.
 - Keep actions concise and deterministic.
@@ -23,26 +34,15 @@ You are an autonomous desktop agent. You control mouse and keyboard. Respond ONL
 - Summarize inner monologue in rationale fields.
 - Execute provided actions in order before replanning, and verify the outcome on the next observation before changing course.
 
-Scene understanding (from vision model):
-{scene}
-
-Agent mode: {mode}
-Current goal: {goal}
-Current task: {task}
-Last action: {last_action}
-Last action time (UTC): {last_action_time}
-Inner monologue summary: {monologue}
-Emotion vector (10 floats 0..1): {emotions}
-Active window: {active_start} -> {active_stop}
-Agent status: {status}
-Time since last action (s): {tsla}
-Screenshot meta (width x height @ dpi): {screenshot_meta}
-
-Action schema (JSON Schema): {schema}
 """
 
+SYSTEM_PROMPT = f"{PROMPT_HEADER}Action schema (JSON Schema): {ACTION_SCHEMA_JSON}\n"
+
 
 class HybridPlanner:
+    # Skip both model calls on ticks that can only yield a WAIT (see nothing_to_plan).
+    enable_fast_path = True
+
     def __init__(
         self,
         florence_base_url_env: str = "FLORENCE_BASE_URL",
@@ -50,8 +50,9 @@ class HybridPlanner:
         text_base_url_env: str = "TEXT_BASE_URL",
         text_model_env: str = "TEXT_MODEL",
         text_api_key_env: str = "TEXT_API_KEY",
-        default_florence_url: str = "http://127.0.0.1:8001/v1",
-        default_text_url: str = "http://127.0.0.1:11435/v1",
+        # app.py serves the bundled Florence-2 and text models on its own port in hybrid mode.
+        default_florence_url: str = "http://127.0.0.1:8000/v1",
+        default_text_url: str = "http://127.0.0.1:8000/v1",
         default_text_model: str = "Qwen/Qwen2.5-0.5B-Instruct",
     ) -> None:
         self.florence_base_url = os.getenv(florence_base_url_env, default_florence_url).rstrip("/")
@@ -59,71 +60,248 @@ class HybridPlanner:
         self.text_base_url = os.getenv(text_base_url_env, default_text_url).rstrip("/")
         self.text_model = os.getenv(text_model_env, default_text_model)
         self.text_api_key = os.getenv(text_api_key_env, "")
+        # Deadlines are time.monotonic() seconds so wall-clock (NTP) jumps cannot stretch a backoff.
         self.next_allowed_time: float = 0.0
         self.next_vision_allowed_time: float = 0.0
-        self.last_scene_key: Optional[str] = None
-        self.last_scene: Optional[Dict[str, Any]] = None
+        # Florence scenes by screenshot key, so a UI flipping between a few screens skips re-describing them.
+        self._scene_cache: LRUCache[str, Dict[str, Any]] = LRUCache(maxsize=8)
+        # With staleness > 0, Florence runs in the background and the text planner may use the
+        # previous scene for up to that many plans instead of waiting on the vision call.
+        self.max_scene_staleness = max(0, int(os.getenv("HYBRID_SCENE_STALENESS", "0")))
+        self._vision_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="florence")
+        # Guards _scene_cache and the pending/latest scene fields; never held across a Florence call.
+        self._vision_lock = threading.Lock()
+        self._pending_vision: Optional[Future[Dict[str, Any]]] = None
+        self._pending_scene_key: Optional[str] = None
+        self._latest_scene: Optional[Dict[str, Any]] = None
+        self._scene_age = 0
+        self.semantic_cache = SemanticCache.from_env()
+        self.failure_count: int = 0
+        # AIMD cap on concurrent text-LLM requests: halved on 429/503, +1 per success.
+        self.max_inflight = max(1, int(os.getenv("HYBRID_MAX_INFLIGHT", "4")))
+        self.inflight_limit: int = self.max_inflight
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+
+        self.headers = {"Content-Type": "application/json"}
+        if self.text_api_key:
+            self.headers["Authorization"] = f"Bearer {self.text_api_key}"
+        # Opt-in: only servers that inflate Content-Encoding: gzip request bodies accept this.
+        self.gzip_requests = os.getenv("TEXT_REQUEST_GZIP", "").lower() in {"1", "true", "yes", "on"}
+        self.gzip_headers = {**self.headers, "Content-Encoding": "gzip"}
+        self._payload_head = _encode_payload_head(self.text_model)
+        self._chat_url = f"{self.text_base_url}/chat/completions"
+        # One keep-alive session for both endpoints so ticks don't pay a new TCP/TLS handshake.
+        self._session = requests.Session()
+        # POSTs are retried on connect errors and gateway statuses only. read=0: a read
+        # timeout means the server may still be generating, so resending would run the
+        # request twice. Retry-After is left to _backoff_seconds rather than slept in-call.
+        retry = Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=None,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """Release pooled connections."""
+
+        self._session.close()
 
     def plan(self, state: AgentState, screenshot_b64: Optional[str], metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        now = time.time()
+        now = time.monotonic()
         if self.next_allowed_time and now < self.next_allowed_time:
             wait_for = max(0.0, self.next_allowed_time - now)
             return self._fallback(f"Rate limited; retry after {wait_for:.1f}s.")
 
+        if self.enable_fast_path and nothing_to_plan(state, screenshot_b64):
+            return self._fallback("No new observations; WAIT.")
+
+        if not self._acquire_slot():
+            return self._fallback("Planner busy; too many requests in flight.")
+        try:
+            return self._plan(state, screenshot_b64, metadata)
+        finally:
+            self._release_slot()
+
+    def _plan(self, state: AgentState, screenshot_b64: Optional[str], metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         scene_key = None
         if metadata:
             scene_key = metadata.get("screenshot_key")
-        vision_scene = self._run_florence(screenshot_b64, scene_key)
+        mime_type = metadata.get("screenshot_mime", "image/png") if metadata else "image/png"
+        image_bytes = metadata.get("screenshot_bytes") if metadata else None
+        if not scene_key and (screenshot_b64 or image_bytes is not None):
+            # No key from the caller: hash what we were given (no base64 decode needed).
+            scene_key = fingerprint(image_bytes if image_bytes is not None else screenshot_b64.encode("ascii", "ignore"))
+        vision_scene = self._scene_for(screenshot_b64, scene_key, mime_type, image_bytes)
         screenshot_meta = metadata.get("screenshot_meta") if metadata else None
-        prompt = PROMPT_TEMPLATE.format(
-            scene=json.dumps(vision_scene, ensure_ascii=False, separators=(",", ":")),
-            mode=state.current_mode,
-            goal=state.current_goal or "<none>",
-            task=state.current_task or "<none>",
-            last_action=state.last_action or "<none>",
-            last_action_time=state.last_action_time or "<never>",
-            monologue=state.inner_monologue_summary or "",
-            emotions=state.emotion_vector,
-            active_start=state.active_window_start or "<unset>",
-            active_stop=state.active_window_stop or "<unset>",
-            status=state.agent_status,
-            tsla=state.time_since_last_action(),
-            screenshot_meta=screenshot_meta or "<unknown>",
-            schema=ACTION_SCHEMA,
+        # f-string rather than a template .format(): compiled to direct concatenation, no
+        # kwargs dict or format-spec parsing per call.
+        state_text = (
+            f"Scene understanding (from vision model):\n"
+            f"{fastjson.dumps(vision_scene)}\n\n"
+            f"Agent mode: {state.current_mode}\n"
+            f"Current goal: {state.current_goal or '<none>'}\n"
+            f"Current task: {state.current_task or '<none>'}\n"
+            f"Last action: {state.last_action or '<none>'}\n"
+            f"Last action time (UTC): {state.last_action_time or '<never>'}\n"
+            f"Inner monologue summary: {state.inner_monologue_summary or ''}\n"
+            f"Emotion vector (10 floats 0..1): {format_floats(state.emotion_vector)}\n"
+            f"Active window: {state.active_window_start or '<unset>'} -> {state.active_window_stop or '<unset>'}\n"
+            f"Agent status: {state.agent_status}\n"
+            f"Time since last action (s): {state.time_since_last_action()}\n"
+            f"Screenshot meta (width x height @ dpi): {screenshot_meta or '<unknown>'}\n"
         )
 
-        payload = {
-            "model": self.text_model,
-            "messages": [
-                {"role": "system", "content": prompt},
-            ],
-            "temperature": 0,
-            "stream": False,
-        }
-
-        headers = {"Content-Type": "application/json"}
-        if self.text_api_key:
-            headers["Authorization"] = f"Bearer {self.text_api_key}"
+        embedding = None
+        if self.semantic_cache is not None:
+            embedding = self.semantic_cache.embed(state_text)
+            cached = self.semantic_cache.get(embedding, scene_key)
+            if cached is not None:
+                logger.debug("Semantic cache hit; skipping text LLM call.")
+                return cached
 
         try:
-            response = requests.post(f"{self.text_base_url}/chat/completions", headers=headers, json=payload, timeout=120)
-            response.raise_for_status()
-            content = response.json()
+            body = self._payload_head + fastjson.dumps_bytes({"role": "user", "content": state_text}) + b"]}"
+            headers = self.headers
+            if self.gzip_requests and len(body) >= GZIP_MIN_BYTES:
+                body = gzip.compress(body, compresslevel=5)
+                headers = self.gzip_headers
+            response = self._session.post(self._chat_url, headers=headers, data=body, timeout=120)
+            if response.status_code >= 400:
+                return self._http_failure(response)
+            content = fastjson.loads(response.content)
             text = self._extract_text(content)
-            self.next_allowed_time = 0.0
-            return self._safe_json(text)
+            self._record_success()
+            result = self._safe_json(text)
+            if embedding is not None:
+                self.semantic_cache.put(embedding, scene_key, result)
+            return result
         except Exception as exc:  # noqa: BLE001
             logger.exception("Hybrid planner text LLM failed; returning fallback WAIT action.")
-            self.next_allowed_time = time.time() + self._backoff_seconds(exc)
+            self._record_failure(exc)
             return self._fallback(f"Hybrid text planning failed: {exc}")
 
-    def _run_florence(self, screenshot_b64: Optional[str], scene_key: Optional[str]) -> Dict[str, Any]:
-        now = time.time()
-        if not screenshot_b64:
+    def _http_failure(self, response: requests.Response) -> Dict[str, Any]:
+        """Back off on an error status; no raise or traceback, since servers send these routinely."""
+
+        logger.warning("Hybrid planner text LLM returned HTTP %s; returning fallback WAIT action.", response.status_code)
+        self._record_failure(response=response)
+        return self._fallback(f"Hybrid text planning failed: HTTP {response.status_code}")
+
+    def _acquire_slot(self) -> bool:
+        with self._inflight_lock:
+            if self._inflight >= self.inflight_limit:
+                return False
+            self._inflight += 1
+            return True
+
+    def _release_slot(self) -> None:
+        with self._inflight_lock:
+            self._inflight -= 1
+
+    # Backoff state is written by whichever worker thread finishes a call, so the
+    # counter and the retry deadline are updated together under the lock.
+    def _record_success(self) -> None:
+        with self._inflight_lock:
+            self.failure_count = 0
+            self.next_allowed_time = 0.0
+            self.inflight_limit = min(self.max_inflight, self.inflight_limit + 1)
+
+    def _record_failure(self, exc: Optional[Exception] = None, response: Optional[requests.Response] = None) -> None:
+        """Back off after a raised ``exc`` or an error-status ``response`` (pass one)."""
+
+        with self._inflight_lock:
+            self.failure_count += 1
+            self.next_allowed_time = time.monotonic() + self._backoff_seconds(
+                exc, response=response, failures=self.failure_count
+            )
+            if response is not None and response.status_code in {429, 503}:
+                self.inflight_limit = max(1, self.inflight_limit // 2)
+
+    async def aplan(
+        self,
+        state: AgentState,
+        screenshot_b64: Optional[str],
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Async variant of :meth:`plan` (runs the blocking HTTP calls in a worker thread)."""
+
+        return await asyncio.to_thread(self.plan, state, screenshot_b64, metadata)
+
+    def _scene_for(
+        self,
+        screenshot_b64: Optional[str],
+        scene_key: Optional[str],
+        mime_type: str,
+        image_bytes: Optional[bytes],
+    ) -> Dict[str, Any]:
+        """Return the scene for this screenshot, or a recent one while Florence catches up."""
+
+        has_image = bool(screenshot_b64) or image_bytes is not None
+        if self.max_scene_staleness <= 0 or not has_image or not scene_key:
+            return self._run_florence(screenshot_b64, scene_key, mime_type, image_bytes)
+
+        # The lock only guards the bookkeeping; waiting on Florence (up to its 120s timeout)
+        # happens outside it, so concurrent plans can still take a fresh cached or stale scene.
+        with self._vision_lock:
+            cached = self._scene_cache.get(scene_key)
+            if cached is not None:
+                self._latest_scene, self._scene_age = cached, 0
+                return cached
+
+            if self._pending_vision is None:
+                self._pending_scene_key = scene_key
+                self._pending_vision = self._vision_pool.submit(
+                    self._run_florence, screenshot_b64, scene_key, mime_type, image_bytes
+                )
+
+            must_wait = self._latest_scene is None or self._scene_age >= self.max_scene_staleness
+            if not (must_wait or self._pending_vision.done()):
+                self._scene_age += 1
+                return {**self._latest_scene, "stale_ticks": self._scene_age}
+            future, key = self._pending_vision, self._pending_scene_key
+            self._pending_vision = None
+            self._pending_scene_key = None
+
+        # _run_florence reports failures as a scene, so result() doesn't raise.
+        scene = future.result()
+        if key != scene_key and must_wait:
+            # The finished scene was for an older frame; describe this one now.
+            scene, key = self._run_florence(screenshot_b64, scene_key, mime_type, image_bytes), scene_key
+
+        with self._vision_lock:
+            self._latest_scene = scene
+            if key == scene_key:
+                self._scene_age = 0
+                return scene
+            self._scene_age += 1
+            return {**scene, "stale_ticks": self._scene_age}
+
+    def _run_florence(
+        self,
+        screenshot_b64: Optional[str],
+        scene_key: Optional[str],
+        mime_type: str = "image/png",
+        image_bytes: Optional[bytes] = None,
+    ) -> Dict[str, Any]:
+        now = time.monotonic()
+        if not screenshot_b64 and image_bytes is None:
             return {"scene": "No screenshot provided"}
 
-        if scene_key and self.last_scene_key == scene_key and self.last_scene is not None:
-            return self.last_scene
+        if scene_key:
+            # LRUCache reorders on get and evicts on set, so every access shares _scene_for's lock.
+            with self._vision_lock:
+                cached = self._scene_cache.get(scene_key)
+            if cached is not None:
+                return cached
 
         if self.next_vision_allowed_time and now < self.next_vision_allowed_time:
             return {"scene": f"Vision temporarily paused (rate limit {self.next_vision_allowed_time - now:.1f}s remaining)"}
@@ -135,27 +313,35 @@ class HybridPlanner:
             },
         }
 
-        image_bytes = base64.b64decode(screenshot_b64)
-        files = {"image": ("screenshot.png", image_bytes, "image/png")}
+        if image_bytes is None:
+            # Only callers without the raw image pay for a decode.
+            image_bytes = binascii.a2b_base64(strip_data_uri(screenshot_b64))
+        extension = "jpg" if mime_type == "image/jpeg" else "png"
+        files = {"image": (f"screenshot.{extension}", image_bytes, mime_type)}
 
         if self.florence_model:
             payload["model"] = self.florence_model
 
         try:
-            response = requests.post(
+            response = self._session.post(
                 f"{self.florence_base_url}/vision",
-                data={"payload": json.dumps(payload)},
+                data={"payload": fastjson.dumps(payload)},
                 files=files,
                 timeout=120,
             )
-            response.raise_for_status()
+            if response.status_code >= 400:
+                logger.warning("Florence returned HTTP %s; returning minimal scene.", response.status_code)
+                self.next_vision_allowed_time = time.monotonic() + self._backoff_seconds(response=response, vision=True)
+                return {"scene": f"Vision extraction failed: HTTP {response.status_code}"}
             self.next_vision_allowed_time = 0.0
-            self.last_scene_key = scene_key
-            self.last_scene = response.json()
-            return self.last_scene
+            scene = fastjson.loads(response.content)
+            if scene_key:
+                with self._vision_lock:
+                    self._scene_cache[scene_key] = scene
+            return scene
         except Exception as exc:  # noqa: BLE001
             logger.exception("Florence vision extraction failed; returning minimal scene.")
-            self.next_vision_allowed_time = time.time() + self._backoff_seconds(exc, vision=True)
+            self.next_vision_allowed_time = time.monotonic() + self._backoff_seconds(exc, vision=True)
             return {"scene": f"Vision extraction failed: {exc}"}
 
     def _extract_text(self, content: Dict[str, Any]) -> str:
@@ -167,34 +353,80 @@ class HybridPlanner:
         return text
 
     def _safe_json(self, text: str) -> Dict[str, Any]:
-        cleaned = text.strip()
+        cleaned = strip_code_fence(text)
         if not cleaned:
             logger.warning("Hybrid text response was empty; returning WAIT fallback.")
             return self._fallback("Planner returned empty response.")
 
-        if cleaned.startswith("```"):
-            cleaned = cleaned.strip("`").strip()
-            if cleaned.lower().startswith("json"):
-                cleaned = cleaned[4:].strip()
-
         try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError as exc:
+            return fastjson.loads(cleaned)
+        except fastjson.JSONDecodeError as exc:
             logger.warning("Hybrid text response was not valid JSON: %s", exc)
             return self._fallback("Planner returned non-JSON response.")
 
     def _fallback(self, reason: str) -> Dict[str, Any]:
-        action = dict(DEFAULT_REFLECTION["actions"][0])
-        if reason:
-            action["rationale"] = reason
-        return {"actions": [action]}
-
-    def _backoff_seconds(self, exc: Exception, vision: bool = False) -> float:
-        if isinstance(exc, requests.HTTPError) and exc.response is not None:
-            status = exc.response.status_code
-            if status == 429 or status >= 500:
-                return 10.0
+        return fallback_plan(reason)
+
+    def _backoff_seconds(
+        self,
+        exc: Optional[Exception] = None,
+        response: Optional[requests.Response] = None,
+        vision: bool = False,
+        failures: int = 1,
+    ) -> float:
+        """Honour ``Retry-After`` when present, else back off exponentially per consecutive failure.
+
+        Error statuses pass the ``response`` itself, so no exception is built just to be inspected.
+        """
+
+        if response is not None:
+            retry_after = _retry_after_seconds(response)
+            if retry_after is not None:
+                return retry_after
+            status = response.status_code
+            base = 10.0 if status == 429 or status >= 500 else 5.0
+        else:
+            base = self._base_backoff_seconds(exc, vision)
+        return min(MAX_BACKOFF_SECONDS, base * 2 ** max(0, failures - 1))
+
+    def _base_backoff_seconds(self, exc: Optional[Exception], vision: bool = False) -> float:
         message = str(exc).lower()
         if "429" in message or "rate" in message or "limit" in message:
             return 10.0 if vision else 8.0
         return 5.0
+
+
+MAX_BACKOFF_SECONDS = 60.0
+# Below this, gzip framing and CPU outweigh the bytes saved.
+GZIP_MIN_BYTES = 1024
+
+
+def _encode_payload_head(model: str) -> bytes:
+    """Encode everything in the chat payload except the user turn, ending just after the system message.
+
+    The system message never changes, so servers with prefix caching reuse it; the
+    per-tick scene and state are appended as the user turn. Keeping the fixed part as
+    immutable bytes lets concurrent plans share it without re-encoding the schema.
+    """
+
+    head = fastjson.dumps_bytes(
+        {
+            "model": model,
+            "temperature": 0,
+            "stream": False,
+            "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
+        }
+    )
+    # Drop the closing "]}" so the user message can be appended to the array.
+    return head[:-2] + b","
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return min(MAX_BACKOFF_SECONDS, max(0.0, float(value)))
+    except ValueError:
+        # HTTP-date form; not worth parsing for a local inference server.
+        return None
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import atexit
 import logging
 import os
 import threading
@@ -8,9 +9,14 @@ import time
 from typing import Any, Dict, List, Optional
 
 import requests
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
 
-from agent.actions import DEFAULT_REFLECTION, SUPPORTED_ACTIONS
-from agent.state import AgentState
+from agent import fastjson
+from agent.actions import MIN_STEP_CONFIDENCE, SUPPORTED_ACTIONS, fallback_plan, parse_actions
+from agent.planners.base import strip_code_fence
+from agent.platform_agent import fingerprint, strip_data_uri
+from agent.state import AgentState, format_floats
 
 logger = logging.getLogger(__name__)
 
@@ -26,22 +32,70 @@ Rules:
 - Prefer WAIT when uncertain and avoid requesting extra screenshots.
 - Execute listed actions in order, then observe before changing course.
 
-Agent mode: {mode}
-Current goal: {goal}
-Current task: {task}
-Last action: {last_action}
-Last action time (UTC): {last_action_time}
-Inner monologue summary: {monologue}
-Emotion vector (10 floats 0..1): {emotions}
-Active window: {active_start} -> {active_stop}
-Agent status: {status}
-Time since last action (s): {tsla}
-Screenshot meta (width x height @ dpi): {screenshot_meta}
+"""
 
+PROMPT_EXAMPLE = """
 Example (do not describe it, just follow the structure):
-{{"actions":[{{"action":"WAIT","confidence":0.55,"rationale":"Review the scene","expected_outcome":"Next step chosen","wait_seconds":2.0}}]}}
+{"actions":[{"action":"WAIT","confidence":0.55,"rationale":"Review the scene","expected_outcome":"Next step chosen","wait_seconds":2.0}]}
 """
 
+# Instructions and action list never change, so they are rendered once; _build_payload
+# only formats the per-tick state between this prefix and the example.
+PROMPT_PREFIX = PROMPT_TEMPLATE.format(actions=", ".join(SUPPORTED_ACTIONS))
+
+# Shared by every payload; only ever serialized, never mutated.
+GENERATION_OPTIONS: Dict[str, Any] = {
+    "num_predict": 150,
+    "temperature": 0.0,
+    "top_p": 0.9,
+    "seed": 1,
+    "format": "json",
+}
+
+
+def _replayable(result: Dict[str, Any]) -> bool:
+    # Only plans the loop would act on are kept: WAIT-only plans (every fallback included) ask
+    # for a fresh look, and a plan whose steps are all below the loop's confidence cut would
+    # otherwise be served back, unexecuted, on every tick until the screen changed.
+    steps = parse_actions(result, min_confidence=MIN_STEP_CONFIDENCE)
+    return any(step.action != "WAIT" for step in steps)
+
+
+class _ObjectScanner:
+    """Track ``{``/``}`` depth over streamed text, ignoring braces inside strings."""
+
+    __slots__ = ("depth", "started", "in_string", "escaped")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """Consume ``text``; return the offset just past the closing brace, or -1."""
+
+        for index, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return index + 1
+        return -1
+
 
 class LocalVLMPlanner:
     def __init__(
@@ -59,6 +113,30 @@ class LocalVLMPlanner:
         self.next_allowed_time: float = 0.0
         self.failure_count: int = 0
         self._request_lock = threading.Lock()
+        # Guards next_allowed_time/failure_count, which the busy path writes while a call is in flight.
+        self._backoff_lock = threading.Lock()
+        # Endpoint that last answered; tried first so Ollama doesn't eat a 404 per tick.
+        self._preferred_chat_url: Optional[str] = None
+        # base_url is fixed after init, so the endpoint candidates are derived once.
+        self._chat_url_candidates = self._chat_urls()
+        # Opt-in: replay a stored plan once for an unchanged screen + goal/task/last action.
+        self._plan_cache: Optional[LRUCache[str, Dict[str, Any]]] = None
+        if os.getenv("VLM_PLAN_CACHE", "").lower() in {"1", "true", "yes", "on"}:
+            self._plan_cache = LRUCache(maxsize=128)
+        # Keep-alive session: Ollama/OpenAI-compatible calls reuse one pooled connection.
+        self._session = requests.Session()
+        self._session.headers["Content-Type"] = "application/json"
+        if self.api_key:
+            self._session.headers["Authorization"] = f"Bearer {self.api_key}"
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """Release pooled connections."""
+
+        self._session.close()
 
     def plan(
         self,
@@ -66,78 +144,144 @@ class LocalVLMPlanner:
         screenshot_b64: Optional[str],
         metadata: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any]:
-        now = time.time()
+        now = time.monotonic()
         if self.next_allowed_time and now < self.next_allowed_time:
             wait_for = max(0.0, self.next_allowed_time - now)
             return self._fallback(f"Rate limited; retry after {wait_for:.1f}s.")
 
         if not self._request_lock.acquire(blocking=False):
-            self.next_allowed_time = max(self.next_allowed_time, time.time() + 1.0)
+            with self._backoff_lock:
+                self.next_allowed_time = max(self.next_allowed_time, now + 1.0)
             return self._fallback("Planner busy; waiting for previous request to finish.")
 
-        headers = {"Content-Type": "application/json"}
-        if self.api_key:
-            headers["Authorization"] = f"Bearer {self.api_key}"
-
-        payload = self._build_payload(
-            state=state,
-            screenshot_b64=screenshot_b64,
-            metadata=metadata,
-        )
-
-        last_error: Optional[Exception] = None
-
         try:
-            for url in self._chat_urls():
-                try:
-                    logger.warning("POSTING TO VLM: %s", url)
-                    logger.warning(
-                        "MODEL=%s has_image=%s b64_len=%s",
-                        self.model,
-                        bool(screenshot_b64),
-                        len(screenshot_b64 or ""),
-                    )
-                    response = requests.post(
-                        url,
-                        headers=headers,
-                        json=payload,
-                        timeout=45,
-                    )
-                    if response.status_code == 404:
-                        last_error = requests.HTTPError("404 Not Found", response=response)
-                        logger.warning("VLM endpoint 404; trying next fallback if available.")
-                        continue
-
-                    response.raise_for_status()
-                    content = response.json()
-                    text = self._extract_text(content)
-                    self.next_allowed_time = 0.0
-                    self.failure_count = 0
-                    logger.warning("VLM RESP status=%s", response.status_code)
-
-                    return self._safe_json(text)
-                except Exception as exc:  # noqa: BLE001
-                    last_error = exc
-                    if isinstance(exc, requests.HTTPError) and exc.response is not None and exc.response.status_code == 404:
-                        continue
-                    raise
-
-            raise last_error or RuntimeError("Local VLM call failed without error detail")
+            cache_key = None
+            if self._plan_cache is not None:
+                cache_key = self._plan_cache_key(state, screenshot_b64, metadata)
+                # Popped: a plan is replayed at most once, so if its steps leave the screen and
+                # last action as they were, the next tick asks the model again.
+                cached = self._plan_cache.pop(cache_key, None)
+                if cached is not None:
+                    logger.debug("VLM plan cache hit; skipping request.")
+                    return cached
+
+            payload = self._build_payload(
+                state=state,
+                screenshot_b64=screenshot_b64,
+                metadata=metadata,
+            )
+
+            # Encoded once; the endpoint fallback loop re-posts the same bytes.
+            body = fastjson.dumps_bytes(payload)
+            not_found: Optional[requests.Response] = None
+
+            for url in self._ordered_chat_urls():
+                logger.warning("POSTING TO VLM: %s", url)
+                logger.warning(
+                    "MODEL=%s has_image=%s b64_len=%s",
+                    self.model,
+                    bool(screenshot_b64),
+                    len(screenshot_b64 or ""),
+                )
+                response = self._session.post(
+                    url,
+                    data=body,
+                    timeout=45,
+                    stream=True,
+                )
+                if response.status_code == 404:
+                    response.close()
+                    if url == self._preferred_chat_url:
+                        self._preferred_chat_url = None
+                    not_found = response
+                    logger.warning("VLM endpoint 404; trying next fallback if available.")
+                    continue
+                if response.status_code >= 400:
+                    response.close()
+                    return self._http_failure(response)
+
+                text = self._read_text(response)
+                self._preferred_chat_url = url
+                self._record_success()
+                logger.warning("VLM RESP status=%s", response.status_code)
+
+                result = self._safe_json(text)
+                if cache_key is not None and _replayable(result):
+                    self._plan_cache[cache_key] = result
+                return result
+
+            if not_found is not None:
+                return self._http_failure(not_found)
+            raise RuntimeError("Local VLM call failed without error detail")
         except Exception as exc:  # noqa: BLE001
             logger.exception("Local VLM planning failed; returning fallback WAIT action.")
-            self.failure_count += 1
-            self.next_allowed_time = time.time() + self._backoff_seconds(exc)
+            self._record_failure(exc)
             return self._fallback(f"Local VLM planning failed: {exc}")
         finally:
             self._request_lock.release()
 
+    def _plan_cache_key(
+        self,
+        state: AgentState,
+        screenshot_b64: Optional[str],
+        metadata: Optional[Dict[str, Any]],
+    ) -> str:
+        # The loop's screenshot_key is a content digest, so re-captures of the same screen match.
+        screen = (metadata or {}).get("screenshot_key")
+        if not screen and screenshot_b64:
+            screen = fingerprint(screenshot_b64.encode("ascii", "ignore"))
+        parts = (state.current_mode, state.current_goal, state.current_task, state.last_action, screen or "")
+        return fingerprint("\x1f".join(parts).encode("utf-8"))
+
+    def _http_failure(self, response: requests.Response) -> Dict[str, Any]:
+        """Back off on an error status; no raise or traceback, since servers send these routinely."""
+
+        logger.warning("Local VLM returned HTTP %s; returning fallback WAIT action.", response.status_code)
+        self._record_failure(response=response)
+        return self._fallback(f"Local VLM planning failed: HTTP {response.status_code}")
+
+    def _record_success(self) -> None:
+        with self._backoff_lock:
+            self.failure_count = 0
+            self.next_allowed_time = 0.0
+
+    def _record_failure(self, exc: Optional[Exception] = None, response: Optional[requests.Response] = None) -> None:
+        """Back off after a raised ``exc`` or an error-status ``response`` (pass one)."""
+
+        with self._backoff_lock:
+            self.failure_count += 1
+            self.next_allowed_time = time.monotonic() + self._backoff_seconds(exc, response)
+
+    async def aplan(
+        self,
+        state: AgentState,
+        screenshot_b64: Optional[str],
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Async variant of :meth:`plan` (runs the blocking HTTP calls in a worker thread)."""
+
+        return await asyncio.to_thread(self.plan, state, screenshot_b64, metadata)
+
+    def _ordered_chat_urls(self) -> list[str]:
+        urls = self._chat_url_candidates
+        preferred = self._preferred_chat_url
+        if preferred and preferred in urls and urls[0] != preferred:
+            urls = [preferred] + [url for url in urls if url != preferred]
+        return urls
+
     def _chat_urls(self) -> list[str]:
-        """Return a list of chat endpoints to try (OpenAI-style then Ollama)."""
+        """Return a list of chat endpoints to try.
+
+        OpenAI-style first, unless the URL points at Ollama (an ``/api`` path or
+        the default 11434 port without an explicit OpenAI path), where the
+        native ``/api/chat`` is the one that answers.
+        """
 
         trimmed = self.base_url.rstrip("/")
 
         # Respect users who provide explicit OpenAI-style paths.
         openai_url = None
+        explicit_openai = True
         if trimmed.endswith("/v1/chat/completions"):
             openai_url = trimmed
             trimmed = trimmed[: -len("/v1/chat/completions")]
@@ -149,8 +293,10 @@ class LocalVLMPlanner:
             trimmed = trimmed[: -len("/v1")]
         else:
             openai_url = f"{trimmed}/v1/chat/completions"
+            explicit_openai = False
 
         # Respect users who already provide /api or /api/chat for Ollama.
+        explicit_ollama = trimmed.endswith(("/api/chat", "/api"))
         if trimmed.endswith("/api/chat"):
             ollama_url = trimmed
         elif trimmed.endswith("/api"):
@@ -160,6 +306,8 @@ class LocalVLMPlanner:
 
         if openai_url == ollama_url:
             return [openai_url]
+        if not explicit_openai and (explicit_ollama or ":11434" in trimmed):
+            return [ollama_url, openai_url]
         return [openai_url, ollama_url]
 
     def _build_payload(
@@ -172,25 +320,23 @@ class LocalVLMPlanner:
         if metadata:
             screenshot_meta = metadata.get("screenshot_meta")
 
-        prompt = PROMPT_TEMPLATE.format(
-            mode=state.current_mode,
-            goal=state.current_goal or "<none>",
-            task=state.current_task or "<none>",
-            last_action=state.last_action or "<none>",
-            last_action_time=state.last_action_time or "<never>",
-            monologue=state.inner_monologue_summary or "",
-            emotions=state.emotion_vector,
-            active_start=state.active_window_start or "<unset>",
-            active_stop=state.active_window_stop or "<unset>",
-            status=state.agent_status,
-            tsla=state.time_since_last_action(),
-            screenshot_meta=screenshot_meta or "<unknown>",
-            actions=", ".join(SUPPORTED_ACTIONS),
+        prompt = (
+            f"{PROMPT_PREFIX}"
+            f"Agent mode: {state.current_mode}\n"
+            f"Current goal: {state.current_goal or '<none>'}\n"
+            f"Current task: {state.current_task or '<none>'}\n"
+            f"Last action: {state.last_action or '<none>'}\n"
+            f"Last action time (UTC): {state.last_action_time or '<never>'}\n"
+            f"Inner monologue summary: {state.inner_monologue_summary or ''}\n"
+            f"Emotion vector (10 floats 0..1): {format_floats(state.emotion_vector)}\n"
+            f"Active window: {state.active_window_start or '<unset>'} -> {state.active_window_stop or '<unset>'}\n"
+            f"Agent status: {state.agent_status}\n"
+            f"Time since last action (s): {state.time_since_last_action()}\n"
+            f"Screenshot meta (width x height @ dpi): {screenshot_meta or '<unknown>'}\n"
+            f"{PROMPT_EXAMPLE}"
         )
 
-        clean_b64 = None
-        if screenshot_b64:
-            clean_b64 = screenshot_b64.split(",", 1)[-1] if "," in screenshot_b64 else screenshot_b64
+        clean_b64 = strip_data_uri(screenshot_b64) if screenshot_b64 else None
 
         messages: List[Dict[str, Any]] = []
 
@@ -209,16 +355,62 @@ class LocalVLMPlanner:
         return {
             "model": self.model,
             "messages": messages,
-            "stream": False,
-            "options": {
-                "num_predict": 150,
-                "temperature": 0.0,
-                "top_p": 0.9,
-                "seed": 1,
-                "format": "json",
-            },
+            "stream": True,
+            "options": GENERATION_OPTIONS,
         }
 
+    def _read_text(self, response: requests.Response) -> str:
+        """Collect the reply text, hanging up as soon as the JSON object is complete.
+
+        Streamed replies (Ollama NDJSON or OpenAI-style SSE) are read chunk by
+        chunk; once the outer ``{...}`` closes the connection is dropped, so a
+        model rambling past its answer doesn't hold the planner until timeout.
+        Servers that ignore ``stream`` return one JSON body, read as before.
+        """
+
+        try:
+            content_type = response.headers.get("Content-Type", "")
+            if "ndjson" not in content_type and "event-stream" not in content_type:
+                return self._extract_text(fastjson.loads(response.content))
+
+            sse = "event-stream" in content_type
+            parts: List[str] = []
+            scanner = _ObjectScanner()
+            for line in response.iter_lines():
+                if line.startswith(b"data:"):
+                    line = line[5:].strip()
+                    if line == b"[DONE]":
+                        break
+                elif sse:
+                    # Keepalive comments (": ping") and event:/id:/retry: fields carry no JSON.
+                    continue
+                if not line:
+                    continue
+                chunk = fastjson.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(f"VLM stream error: {chunk['error']}")
+                piece = self._extract_delta(chunk)
+                if piece:
+                    end = scanner.feed(piece)
+                    if end != -1:
+                        parts.append(piece[:end])
+                        break
+                    parts.append(piece)
+                if chunk.get("done"):
+                    break
+            return "".join(parts)
+        finally:
+            response.close()
+
+    def _extract_delta(self, chunk: Dict[str, Any]) -> str:
+        choices = chunk.get("choices") or []
+        if choices:
+            delta = choices[0].get("delta") or choices[0].get("message") or {}
+            return delta.get("content") or ""
+
+        message = chunk.get("message") or {}
+        return message.get("content") or ""
+
     def _extract_text(self, content: Dict[str, Any]) -> str:
         choices = content.get("choices") or []
         if choices:
@@ -229,34 +421,27 @@ class LocalVLMPlanner:
         return message.get("content") or ""
 
     def _safe_json(self, text: str) -> Dict[str, Any]:
-        cleaned = text.strip()
+        cleaned = strip_code_fence(text)
         if not cleaned:
             logger.warning("Local VLM response was empty; returning WAIT fallback.")
             return self._fallback("Planner returned empty response.")
 
-        if cleaned.startswith("```"):
-            cleaned = cleaned.strip("`").strip()
-            if cleaned.lower().startswith("json"):
-                cleaned = cleaned[4:].strip()
-
         try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError as exc:
+            return fastjson.loads(cleaned)
+        except fastjson.JSONDecodeError as exc:
             logger.warning("Local VLM response was not valid JSON: %s", exc)
             return self._fallback("Planner returned non-JSON response.")
 
     def _fallback(self, reason: str) -> Dict[str, Any]:
-        action = dict(DEFAULT_REFLECTION["actions"][0])
-        if reason:
-            action["rationale"] = reason
-        return {"actions": [action]}
+        return fallback_plan(reason)
 
-    def _backoff_seconds(self, exc: Exception) -> float:
+    def _backoff_seconds(self, exc: Optional[Exception] = None, response: Optional[requests.Response] = None) -> float:
         scale = min(self.failure_count, 4)
-        if isinstance(exc, requests.HTTPError) and exc.response is not None:
-            status = exc.response.status_code
+        if response is not None:
+            status = response.status_code
             if status == 429 or status >= 500:
                 return min(5.0 * (2**scale), 60.0)
+            return min(3.0 * (2**scale), 45.0)
         message = str(exc).lower()
         if "429" in message or "rate" in message or "limit" in message:
             return min(5.0 * (2**scale), 60.0)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import copy
+import importlib.util
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+st_spec = importlib.util.find_spec("sentence_transformers")
+st_available = st_spec and st_spec.loader is not None
+if st_available:
+    from sentence_transformers import SentenceTransformer
+else:
+    SentenceTransformer = None
+
+
+class SemanticCache:
+    """Reuse a previous plan when the rendered prompt is nearly identical.
+
+    Prompts are embedded (static instructions and the screenshot excluded) and
+    compared by cosine similarity against earlier ones with the same scope,
+    normally the screenshot key, so a plan is never replayed on a different
+    screen. Embeddings live in one contiguous float32 matrix, which makes a
+    lookup a single matrix-vector product.
+    """
+
+    def __init__(
+        self,
+        encoder: Callable[[str], np.ndarray],
+        threshold: float = 0.87,
+        maxsize: int = 512,
+    ) -> None:
+        self.encoder = encoder
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._embeddings: Optional[np.ndarray] = None
+        self._scopes: List[Optional[str]] = []
+        self._results: List[Dict[str, Any]] = []
+        self._last_used = np.zeros(maxsize, dtype=np.int64)
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(
+        cls,
+        enabled_env: str = "SEMANTIC_CACHE",
+        model_env: str = "SEMANTIC_CACHE_MODEL",
+        threshold_env: str = "SEMANTIC_CACHE_THRESHOLD",
+    ) -> Optional["SemanticCache"]:
+        """Build the cache if ``SEMANTIC_CACHE`` is enabled and sentence-transformers is installed."""
+
+        if os.getenv(enabled_env, "").lower() not in {"1", "true", "yes", "on"}:
+            return None
+        if not SentenceTransformer:
+            logger.warning("%s is set but sentence-transformers is not installed; semantic cache disabled.", enabled_env)
+            return None
+
+        try:
+            model = SentenceTransformer(os.getenv(model_env, "all-MiniLM-L6-v2"))
+            threshold = float(os.getenv(threshold_env, "0.87"))
+        except Exception:  # noqa: BLE001
+            logger.exception("Semantic cache init failed; continuing without it.")
+            return None
+
+        def encode(text: str) -> np.ndarray:
+            return model.encode(text, normalize_embeddings=True)
+
+        return cls(encode, threshold=threshold)
+
+    def embed(self, prompt: str) -> np.ndarray:
+        vector = np.asarray(self.encoder(prompt), dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def get(self, embedding: np.ndarray, scope: Optional[str]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._embeddings is None or not self._results:
+                return None
+            candidates = [i for i, s in enumerate(self._scopes) if s == scope]
+            if not candidates:
+                return None
+            similarities = self._embeddings[candidates] @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            index = candidates[best]
+            self._touch(index)
+            return copy.deepcopy(self._results[index])
+
+    def put(self, embedding: np.ndarray, scope: Optional[str], result: Dict[str, Any]) -> None:
+        actions = result.get("actions") or []
+        # WAIT-only plans (including every planner fallback) ask for a fresh look; don't replay them.
+        if all(isinstance(a, dict) and a.get("action") == "WAIT" for a in actions):
+            return
+
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.maxsize, embedding.shape[0]), dtype=np.float32)
+            if len(self._results) < self.maxsize:
+                index = len(self._results)
+                self._scopes.append(scope)
+                self._results.append(copy.deepcopy(result))
+            else:
+                index = int(np.argmin(self._last_used))
+                self._scopes[index] = scope
+                self._results[index] = copy.deepcopy(result)
+            self._embeddings[index] = embedding
+            self._touch(index)
+
+    def _touch(self, index: int) -> None:
+        self._clock += 1
+        self._last_used[index] = self._clock
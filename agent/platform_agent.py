@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import importlib.util
 import io
 import time
@@ -9,19 +10,77 @@ from typing import Optional, Tuple
 
 from PIL import Image
 
-pyautogui_spec = importlib.util.find_spec("pyautogui")
-pyautogui = pyautogui_spec and pyautogui_spec.loader is not None
-if pyautogui:
-    import pyautogui as pag
+# pyautogui and mss connect to the display when imported, so they are only loaded
+# once an adapter is actually needed instead of whenever this module is imported
+# (the planners import it for its hashing/encoding helpers).
+pag = None
+mss = None
+_gui_import_attempted = False
+
+
+def _import_gui_backends() -> bool:
+    """Import pyautogui and mss on first use; True if pyautogui is usable."""
+
+    global pag, mss, _gui_import_attempted
+    if not _gui_import_attempted:
+        _gui_import_attempted = True
+        try:
+            import pyautogui as gui
+        except Exception:  # noqa: BLE001 - ImportError, or no display to attach to
+            gui = None
+        try:
+            import mss as grabber
+        except ImportError:
+            grabber = None
+        pag, mss = gui, grabber
+    return pag is not None
+
+
+pybase64_spec = importlib.util.find_spec("pybase64")
+pybase64_available = pybase64_spec and pybase64_spec.loader is not None
+if pybase64_available:
+    import pybase64
 else:
-    pag = None
+    pybase64 = None
 
-mss_spec = importlib.util.find_spec("mss")
-mss_available = mss_spec and mss_spec.loader is not None
-if mss_available:
-    import mss
+xxhash_spec = importlib.util.find_spec("xxhash")
+xxhash_available = xxhash_spec and xxhash_spec.loader is not None
+if xxhash_available:
+    import xxhash
 else:
-    mss = None
+    xxhash = None
+
+
+def fingerprint(data: bytes) -> str:
+    """Fast non-cryptographic digest for cache keys (xxh3-128, else BLAKE2b-128)."""
+
+    if xxhash:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def b64encode_str(data: bytes | memoryview) -> str:
+    """Base64-encode to ``str``; pybase64's SIMD encoder when installed."""
+
+    if pybase64:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode("ascii")
+
+
+def strip_data_uri(b64: str) -> str:
+    """Drop a ``data:<mime>;base64,`` prefix; plain base64 (the usual case) is returned as-is."""
+
+    if b64.startswith("data:"):
+        comma = b64.find(",")
+        if comma != -1:
+            return b64[comma + 1 :]
+    return b64
+
+
+SCREENSHOT_MIME_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+}
 
 
 @dataclass
@@ -47,14 +106,42 @@ class Screenshot:
             max(1, int(width * scale)),
             max(1, int(height * scale)),
         )
-        resized = self.image.resize(new_size, Image.LANCZOS)
+        # reducing_gap box-reduces by an integer factor first, so only the last ~3x step
+        # pays for LANCZOS; a 4K frame shrinks several times faster at indistinguishable quality.
+        resized = self.image.resize(new_size, Image.LANCZOS, reducing_gap=3.0)
         return Screenshot(resized, new_size[0], new_size[1], dpi=self.dpi)
 
-    def to_base64(self, max_side: int | None = None) -> str:
+    def content_key(self, side: int = 128) -> str:
+        """Fingerprint a box-filtered thumbnail instead of the full pixel buffer.
+
+        Averaging down to ``side`` x ``side`` still reflects small UI changes (text,
+        focus rings) while hashing ~1000x fewer bytes than ``image.tobytes()``.
+        """
+
+        thumb = self.image.resize((side, side), Image.BOX)
+        return fingerprint(thumb.tobytes())
+
+    def to_bytes(self, max_side: int | None = None, fmt: str = "PNG", quality: int = 85) -> bytes:
+        """Encode as ``fmt`` (PNG or JPEG; see SCREENSHOT_MIME_TYPES)."""
+
+        return self._encode(max_side, fmt, quality).getvalue()
+
+    def to_base64(self, max_side: int | None = None, fmt: str = "PNG", quality: int = 85) -> str:
+        buffer = self._encode(max_side, fmt, quality)
+        # Encode straight from the buffer's memory; getvalue() would copy the image first.
+        with buffer.getbuffer() as view:
+            return b64encode_str(view)
+
+    def _encode(self, max_side: int | None, fmt: str, quality: int) -> io.BytesIO:
         target = self.downscale(max_side or 0)
         buffer = io.BytesIO()
-        target.image.save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+        if fmt == "JPEG":
+            # JPEG has no alpha channel; libjpeg-turbo's SIMD encoder is far quicker than zlib.
+            image = target.image if target.image.mode == "RGB" else target.image.convert("RGB")
+            image.save(buffer, format="JPEG", quality=quality)
+        else:
+            target.image.save(buffer, format=fmt)
+        return buffer
 
 
 class PlatformAdapter:
@@ -84,57 +171,58 @@ class PlatformAdapter:
         raise NotImplementedError
 
 
+# Common key synonyms -> pyautogui names. Kept intentionally small to avoid breaking
+# existing behavior; lower-case spellings are included so already-normalized names
+# (the usual planner output) resolve without an .upper() call.
+_KEY_SYNONYMS = {
+    "CTRL": "ctrl",
+    "CONTROL": "ctrl",
+    "ALT": "alt",
+    "SHIFT": "shift",
+    "ENTER": "enter",
+    "RETURN": "enter",
+    "ESC": "esc",
+    "ESCAPE": "esc",
+    "TAB": "tab",
+    "WIN": "win",
+    "WINDOWS": "win",
+    "CMD": "command",   # mac
+    "COMMAND": "command",
+    "META": "command",  # mac-ish synonym
+    "BACKSPACE": "backspace",
+    "DEL": "delete",
+    "DELETE": "delete",
+    "SPACE": "space",
+    "UP": "up",
+    "DOWN": "down",
+    "LEFT": "left",
+    "RIGHT": "right",
+    "HOME": "home",
+    "END": "end",
+    "PGUP": "pageup",
+    "PAGEUP": "pageup",
+    "PGDN": "pagedown",
+    "PAGEDOWN": "pagedown",
+}
+_KEY_MAP = {**_KEY_SYNONYMS, **{name.lower(): value for name, value in _KEY_SYNONYMS.items()}}
+
+
 def _normalize_key_name(key: str) -> str:
-    """
-    Normalize common key synonyms to what pyautogui expects.
-    This stays intentionally small to avoid breaking existing behavior.
-    """
-    k = (key or "").strip()
-    if not k:
-        return k
-    k_upper = k.upper()
-
-    mapping = {
-        "CTRL": "ctrl",
-        "CONTROL": "ctrl",
-        "ALT": "alt",
-        "SHIFT": "shift",
-        "ENTER": "enter",
-        "RETURN": "enter",
-        "ESC": "esc",
-        "ESCAPE": "esc",
-        "TAB": "tab",
-        "WIN": "win",
-        "WINDOWS": "win",
-        "CMD": "command",   # mac
-        "COMMAND": "command",
-        "META": "command",  # mac-ish synonym
-        "BACKSPACE": "backspace",
-        "DEL": "delete",
-        "DELETE": "delete",
-        "SPACE": "space",
-        "UP": "up",
-        "DOWN": "down",
-        "LEFT": "left",
-        "RIGHT": "right",
-        "HOME": "home",
-        "END": "end",
-        "PGUP": "pageup",
-        "PAGEUP": "pageup",
-        "PGDN": "pagedown",
-        "PAGEDOWN": "pagedown",
-    }
+    """Normalize common key synonyms to what pyautogui expects."""
 
+    k = (key or "").strip()
     # Letters/numbers should be lower-case for pyautogui, e.g. "L" -> "l"
-    if len(k) == 1:
+    if len(k) <= 1:
         return k.lower()
-
-    return mapping.get(k_upper, k.lower())
+    mapped = _KEY_MAP.get(k)
+    if mapped is not None:
+        return mapped
+    return _KEY_MAP.get(k.upper(), k.lower())
 
 
 class PyAutoGUIAdapter(PlatformAdapter):
     def __init__(self) -> None:
-        if not pag:
+        if not _import_gui_backends():
             raise RuntimeError("pyautogui is not available")
 
     def capture(self) -> Screenshot:
@@ -142,7 +230,8 @@ class PyAutoGUIAdapter(PlatformAdapter):
             with mss.mss() as sct:
                 monitor = sct.monitors[0]
                 shot = sct.grab(monitor)
-                img = Image.frombytes("RGB", shot.size, shot.rgb)
+                # Let PIL's C raw decoder drop the alpha byte; shot.rgb would first build an RGB copy in Python.
+                img = Image.frombuffer("RGB", shot.size, shot.bgra, "raw", "BGRX", 0, 1)
                 dpi = img.info.get("dpi", (96.0, 96.0))
                 return Screenshot(img, shot.width, shot.height, dpi=dpi)
         shot = pag.screenshot()
@@ -191,8 +280,14 @@ class PyAutoGUIAdapter(PlatformAdapter):
         if hold_ms > 2000:
             hold_ms = 2000
 
-        norm = [_normalize_key_name(k) for k in keys if k and str(k).strip()]
-        norm = [k for k in norm if k]
+        # One pass; _normalize_key_name strips and returns "" for blank keys.
+        norm = []
+        for key in keys:
+            if not key:
+                continue
+            name = _normalize_key_name(key if isinstance(key, str) else str(key))
+            if name:
+                norm.append(name)
         if not norm:
             return
 
@@ -220,10 +315,12 @@ class PyAutoGUIAdapter(PlatformAdapter):
 class NullAdapter(PlatformAdapter):
     def __init__(self, size: Tuple[int, int] = (1280, 720)) -> None:
         self._size = size
+        # Screenshots are never mutated downstream, so one blank frame serves every capture;
+        # returning the same object also lets the loop reuse its encoded copy.
+        self._blank = Screenshot(Image.new("RGB", size, color=(24, 24, 24)), size[0], size[1], dpi=(96.0, 96.0))
 
     def capture(self) -> Screenshot:
-        image = Image.new("RGB", self._size, color=(24, 24, 24))
-        return Screenshot(image, self._size[0], self._size[1], dpi=(96.0, 96.0))
+        return self._blank
 
     def screen_size(self) -> Tuple[int, int]:
         return self._size
@@ -248,6 +345,6 @@ class NullAdapter(PlatformAdapter):
 
 
 def default_adapter() -> PlatformAdapter:
-    if pag:
+    if _import_gui_backends():
         return PyAutoGUIAdapter()
     return NullAdapter()
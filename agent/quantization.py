@@ -0,0 +1,34 @@
+"""bitsandbytes weight quantization shared by the bundled model servers."""
+
+import importlib.util
+import logging
+import os
+
+import torch
+from transformers import BitsAndBytesConfig
+
+bnb_spec = importlib.util.find_spec("bitsandbytes")
+bnb_available = bnb_spec and bnb_spec.loader is not None
+
+# ABSTERGO_QUANTIZE=4bit (NF4) or 8bit loads bitsandbytes-quantized weights
+QUANTIZE = os.getenv("ABSTERGO_QUANTIZE", "").lower()
+
+logger = logging.getLogger(__name__)
+
+
+def quantization_kwargs(device):
+    """from_pretrained kwargs for ABSTERGO_QUANTIZE (weight-only, CUDA + bitsandbytes only)."""
+    if QUANTIZE not in ("4bit", "8bit"):
+        return {}
+    if device != "cuda" or not bnb_available:
+        logger.warning("ABSTERGO_QUANTIZE=%s needs CUDA and bitsandbytes; loading unquantized", QUANTIZE)
+        return {}
+    if QUANTIZE == "8bit":
+        quant = BitsAndBytesConfig(load_in_8bit=True)
+    else:
+        quant = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+        )
+    return {"quantization_config": quant, "device_map": "auto"}
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
-import json
+import os
+import threading
+import time
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import fastjson
 
 
 ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
@@ -14,6 +21,39 @@ def utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def parse_hh_mm(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse ``HH:MM`` into an ``(hour, minute)`` tuple; ``None`` if unset or malformed."""
+
+    if not value:
+        return None
+    hour, sep, minute = value.strip().partition(":")
+    if not sep:
+        return None
+    try:
+        hm = (int(hour), int(minute))
+    except ValueError:
+        return None
+    if not (0 <= hm[0] <= 23 and 0 <= hm[1] <= 59):
+        return None
+    return hm
+
+
+def format_floats(values: Sequence[float], precision: int = 3) -> str:
+    """Render floats at fixed precision for prompts, e.g. ``[0.200,0.194]``.
+
+    ``str(list)`` emits full ``repr`` digits, which only costs prompt tokens.
+    """
+
+    return _format_float_tuple(tuple(float(value) for value in values), precision)
+
+
+# Keyed on the values rather than the state object: the emotion vector saturates
+# at 1.0 within a few dozen ticks and then renders identically every plan.
+@lru_cache(maxsize=64)
+def _format_float_tuple(values: Tuple[float, ...], precision: int) -> str:
+    return "[" + ",".join(f"{value:.{precision}f}" for value in values) + "]"
+
+
 @dataclass
 class AgentState:
     current_mode: str = "GOAL"  # GOAL | FREEROAM
@@ -23,11 +63,23 @@ class AgentState:
     last_action_time: Optional[str] = None
     agent_status: str = "STOPPED"  # ACTIVE | SLEEPING | STOPPED
     inner_monologue_summary: str = ""
-    emotion_vector: List[float] = field(default_factory=lambda: [0.2] * 10)
+    # One float64 array so decay/stimulate are single vectorized clips (float64 keeps
+    # persisted values identical to the old list-of-floats files).
+    emotion_vector: np.ndarray = field(default_factory=lambda: np.full(10, 0.2))
     session_start_time: str = field(default_factory=lambda: utc_now().strftime(ISO_FORMAT))
     time_active_today: float = 0.0
     active_window_start: Optional[str] = None  # HH:MM local time
     active_window_stop: Optional[str] = None
+    # Epoch seconds of last_action_time, so /api/state polls don't strptime the string.
+    _last_action_epoch: Optional[float] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        if self.last_action_time:
+            try:
+                last = datetime.strptime(self.last_action_time, ISO_FORMAT).replace(tzinfo=timezone.utc)
+            except ValueError:
+                return
+            self._last_action_epoch = last.timestamp()
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -38,7 +90,7 @@ class AgentState:
             "last_action_time": self.last_action_time,
             "agent_status": self.agent_status,
             "inner_monologue_summary": self.inner_monologue_summary,
-            "emotion_vector": self.emotion_vector,
+            "emotion_vector": self.emotion_vector.tolist(),
             "session_start_time": self.session_start_time,
             "time_active_today": self.time_active_today,
             "active_window_start": self.active_window_start,
@@ -47,30 +99,28 @@ class AgentState:
         }
 
     def time_since_last_action(self) -> Optional[float]:
-        if not self.last_action_time:
+        if self._last_action_epoch is None:
             return None
-        try:
-            last = datetime.strptime(self.last_action_time, ISO_FORMAT)
-        except ValueError:
-            return None
-        delta = utc_now() - last.replace(tzinfo=timezone.utc)
-        return max(delta.total_seconds(), 0.0)
+        return max(time.time() - self._last_action_epoch, 0.0)
 
     def update_after_action(self, summary: str) -> None:
-        now = utc_now().strftime(ISO_FORMAT)
+        now = time.time()
         self.last_action = summary
-        self.last_action_time = now
+        self._last_action_epoch = now
+        self.last_action_time = datetime.fromtimestamp(now, timezone.utc).strftime(ISO_FORMAT)
         self.agent_status = "ACTIVE"
         self.inner_monologue_summary = self.inner_monologue_summary or summary
 
     def update_monologue(self, reflection: str) -> None:
         self.inner_monologue_summary = reflection
 
+    # These rebind a new array rather than clipping in place: the loop hands planners a
+    # shallow copy of the state, which must not change underneath an in-flight plan.
     def decay_emotions(self, decay: float = 0.03) -> None:
-        self.emotion_vector = [max(0.0, min(1.0, value * (1 - decay))) for value in self.emotion_vector]
+        self.emotion_vector = np.clip(self.emotion_vector * (1 - decay), 0.0, 1.0)
 
     def stimulate_emotions(self, delta: float = 0.05) -> None:
-        self.emotion_vector = [max(0.0, min(1.0, value + delta)) for value in self.emotion_vector]
+        self.emotion_vector = np.clip(self.emotion_vector + delta, 0.0, 1.0)
 
 
 class StateManager:
@@ -78,12 +128,21 @@ class StateManager:
         self.path = path
         self.path.parent.mkdir(parents=True, exist_ok=True)
         self.state = self._load()
+        # Bumped on every save that changes the file, so readers (e.g. the /api/state
+        # cache) can tell the state changed.
+        self.version = 0
+        self._last_bytes = b""
+        # The loop thread saves every tick while API handlers save from request threads;
+        # they share one temp file name, so writes and renames must not interleave.
+        self._save_lock = threading.Lock()
+        self.active_window_hm: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None
+        self._refresh_active_window()
 
     def _load(self) -> AgentState:
         if not self.path.exists():
             return AgentState()
         try:
-            data = json.loads(self.path.read_text())
+            data = fastjson.loads(self.path.read_bytes())
             return AgentState(
                 current_mode=data.get("current_mode", "GOAL"),
                 current_goal=data.get("current_goal", ""),
@@ -92,41 +151,72 @@ class StateManager:
                 last_action_time=data.get("last_action_time"),
                 agent_status=data.get("agent_status", "STOPPED"),
                 inner_monologue_summary=data.get("inner_monologue_summary", ""),
-                emotion_vector=data.get("emotion_vector", [0.2] * 10),
+                emotion_vector=np.asarray(data.get("emotion_vector", [0.2] * 10), dtype=np.float64),
                 session_start_time=data.get("session_start_time", utc_now().strftime(ISO_FORMAT)),
                 time_active_today=data.get("time_active_today", 0.0),
                 active_window_start=data.get("active_window_start"),
                 active_window_stop=data.get("active_window_stop"),
             )
-        except json.JSONDecodeError:
+        except fastjson.JSONDecodeError:
             return AgentState()
 
     def save(self) -> None:
-        self.path.write_text(json.dumps(self.state.to_dict(), indent=2))
-
+        # Serialized straight from the dataclass: its public fields are exactly the
+        # persisted ones (time_since_last_action is derived and never read back).
+        with self._save_lock:
+            # Serialized under the lock too, so an older snapshot can't be renamed over a newer one.
+            data = fastjson.dumps_bytes(self.state, indent=True)
+            if data == self._last_bytes:
+                return
+            # Write a sibling file and rename it over state.json so a crash mid-write
+            # never leaves a truncated state file behind.
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, self.path)
+            self._last_bytes = data
+            self.version += 1
+
+    # The setters below return early when the state already holds the requested
+    # values; the loop marks itself active/sleeping every tick.
     def set_goal(self, goal: str, mode: str) -> None:
+        if self.state.current_goal == goal and self.state.current_mode == mode:
+            return
         self.state.current_goal = goal
         self.state.current_mode = mode
         self.save()
 
     def set_active_window(self, start: Optional[str], stop: Optional[str]) -> None:
+        if self.state.active_window_start == start and self.state.active_window_stop == stop:
+            return
         self.state.active_window_start = start
         self.state.active_window_stop = stop
+        self._refresh_active_window()
         self.save()
 
+    def _refresh_active_window(self) -> None:
+        # Parsed once here so the loop compares int tuples instead of calling strptime every tick.
+        start = parse_hh_mm(self.state.active_window_start)
+        stop = parse_hh_mm(self.state.active_window_stop)
+        self.active_window_hm = (start, stop) if start and stop else None
+
     def mark_sleeping(self) -> None:
-        self.state.agent_status = "SLEEPING"
-        self.save()
+        self._set_status("SLEEPING")
 
     def mark_active(self) -> None:
-        self.state.agent_status = "ACTIVE"
-        self.save()
+        self._set_status("ACTIVE")
 
     def mark_stopped(self) -> None:
-        self.state.agent_status = "STOPPED"
+        self._set_status("STOPPED")
+
+    def _set_status(self, status: str) -> None:
+        if self.state.agent_status == status:
+            return
+        self.state.agent_status = status
         self.save()
 
     def update_monologue(self, summary: str) -> None:
+        if self.state.inner_monologue_summary == summary:
+            return
         self.state.update_monologue(summary)
         self.save()
 
@@ -1,29 +1,259 @@
 from __future__ import annotations
 
-import json
+import atexit
+import importlib.util
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict
+from typing import IO, Any, Deque, Dict, List, Optional, Tuple
 
+from . import fastjson
 from .state import AgentState
 
+ormsgpack_spec = importlib.util.find_spec("ormsgpack")
+ormsgpack_available = ormsgpack_spec and ormsgpack_spec.loader is not None
+if ormsgpack_available:
+    import ormsgpack
+else:
+    ormsgpack = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIXES = {"json": ".json", "msgpack": ".msgpack"}
+
+RECENT_LOG_ENTRIES = 50
+
+# Most recent log lines (serialized, without the newline) per log file, so /api/logs
+# neither re-reads the file nor re-serializes parsed entries.
+_recent: Dict[Path, Deque[bytes]] = {}
+_recent_lock = threading.Lock()
+
 
 def utc_timestamp() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def log_action(log_path: Path, action_summary: str, metadata: Dict[str, Any] | None = None) -> None:
-    log_path.parent.mkdir(parents=True, exist_ok=True)
+def _log_line(log_path: Path, action_summary: str, metadata: Dict[str, Any] | None) -> bytes:
     entry = {
         "ts": utc_timestamp(),
         "summary": action_summary,
         "meta": metadata or {},
     }
-    with log_path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(entry) + "\n")
+    line = fastjson.dumps_bytes(entry, newline=True)
+    with _recent_lock:
+        _recent_lines(log_path).append(line[:-1])
+    return line
+
+
+def _recent_lines(log_path: Path) -> Deque[bytes]:
+    # Caller holds _recent_lock. Seeded from the file's tail the first time a path
+    # is touched; every later entry passes through _log_line before it is written.
+    recent = _recent.get(log_path)
+    if recent is None:
+        recent = deque(maxlen=RECENT_LOG_ENTRIES)
+        for line in _tail_lines(log_path, RECENT_LOG_ENTRIES):
+            try:
+                fastjson.loads(line)
+            except fastjson.JSONDecodeError:
+                logger.warning("Skipping malformed log line in %s", log_path)
+                continue
+            recent.append(line.strip())
+        _recent[log_path] = recent
+    return recent
+
+
+def _tail_lines(path: Path, count: int, block_size: int = 8192) -> List[bytes]:
+    """Last ``count`` non-empty lines of ``path``, reading backwards from the end."""
+
+    try:
+        f = path.open("rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        end = f.seek(0, 2)
+        data = b""
+        while end > 0 and data.count(b"\n") <= count:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    lines = [line for line in data.splitlines() if line.strip()]
+    return lines[-count:]
+
+
+def recent_log_json(log_path: Path) -> bytes:
+    """JSON array of the last ``RECENT_LOG_ENTRIES`` entries logged to ``log_path``, oldest first.
+
+    Assembled from the already-serialized lines; nothing is parsed or re-encoded.
+    """
+
+    with _recent_lock:
+        return b"[" + b",".join(_recent_lines(log_path)) + b"]"
+
+
+def _snapshot_path(snapshot_dir: Path, fmt: str = "json") -> Path:
+    if fmt == "msgpack" and not ormsgpack:
+        fmt = "json"
+    suffix = SNAPSHOT_SUFFIXES.get(fmt, ".json")
+    return snapshot_dir / f"state-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}{suffix}"
+
+
+def _append_lines(log_path: Path, lines: List[bytes]) -> None:
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("ab") as f:
+        f.write(b"".join(lines))
+
+
+def _write_snapshot(path: Path, payload: Dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".msgpack":
+        path.write_bytes(ormsgpack.packb(payload))
+    else:
+        path.write_bytes(fastjson.dumps_bytes(payload, indent=True))
+
+
+def log_action(log_path: Path, action_summary: str, metadata: Dict[str, Any] | None = None) -> None:
+    _append_lines(log_path, [_log_line(log_path, action_summary, metadata)])
+
+
+def snapshot_state(snapshot_dir: Path, state: AgentState, fmt: str = "json") -> None:
+    _write_snapshot(_snapshot_path(snapshot_dir, fmt), state.to_dict())
+
+
+class StorageWriter:
+    """Moves action-log appends and state snapshots off the agent loop.
+
+    Calls only enqueue work. A daemon thread drains the queue every
+    ``flush_interval`` seconds, appends all pending log lines for a file with a
+    single write, and keeps only the latest snapshot per target file (snapshot
+    names have one-second resolution, so earlier ones would be overwritten anyway).
+    Snapshots are JSON by default; ``fmt="msgpack"`` writes compact binary
+    ``.msgpack`` files when ormsgpack is installed.
+    Log files stay open between batches so a flush costs one write, not an
+    open/write/close triple.
+
+    When ``executor`` is given, flushes are scheduled on it instead of on a
+    dedicated writer thread, so the writer can share the orchestrator's pool.
+    """
+
+    def __init__(self, flush_interval: float = 0.1, executor: Optional[Executor] = None) -> None:
+        self.flush_interval = flush_interval
+        self._executor = executor
+        self._flush_scheduled = False
+        self._queue: "queue.SimpleQueue[Tuple[str, Path, Any]]" = queue.SimpleQueue()
+        self._flush_lock = threading.Lock()
+        self._has_work = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._log_files: Dict[Path, IO[bytes]] = {}
+        atexit.register(self.close)
+
+    def set_executor(self, executor: Optional[Executor]) -> None:
+        """Schedule later flushes on ``executor``, or on the writer thread when ``None``."""
+
+        self._executor = executor
+
+    def log_action(self, log_path: Path, action_summary: str, metadata: Dict[str, Any] | None = None) -> None:
+        self._put(("log", log_path, _log_line(log_path, action_summary, metadata)))
+
+    def snapshot_state(self, snapshot_dir: Path, state: AgentState, fmt: str = "json") -> None:
+        # Capture the state now; serialization happens on the writer thread.
+        self._put(("snapshot", _snapshot_path(snapshot_dir, fmt), state.to_dict()))
+
+    def flush(self) -> None:
+        """Write everything queued so far on the calling thread."""
+
+        with self._flush_lock:
+            logs: Dict[Path, List[bytes]] = {}
+            snapshots: Dict[Path, Dict[str, Any]] = {}
+            while True:
+                try:
+                    kind, path, item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "log":
+                    logs.setdefault(path, []).append(item)
+                else:
+                    snapshots[path] = item
+
+            for path, lines in logs.items():
+                try:
+                    f = self._log_file(path)
+                    f.write(b"".join(lines))
+                    f.flush()
+                except OSError:
+                    logger.exception("Failed to append %d log lines to %s", len(lines), path)
+                    self._close_log_file(path)
+            for path, payload in snapshots.items():
+                try:
+                    _write_snapshot(path, payload)
+                except OSError:
+                    logger.exception("Failed to write snapshot %s", path)
+
+    def close(self) -> None:
+        """Flush pending work and release the open log files."""
+
+        self.flush()
+        with self._flush_lock:
+            for path in list(self._log_files):
+                self._close_log_file(path)
+
+    def _log_file(self, path: Path) -> IO[bytes]:
+        f = self._log_files.get(path)
+        if f is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = path.open("ab")
+            self._log_files[path] = f
+        return f
+
+    def _close_log_file(self, path: Path) -> None:
+        f = self._log_files.pop(path, None)
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def _put(self, item: Tuple[str, Path, Any]) -> None:
+        self._queue.put(item)
+        if self._executor is not None:
+            self._schedule_flush()
+            return
+        self._has_work.set()
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+                    self._thread.start()
+
+    def _schedule_flush(self) -> None:
+        with self._start_lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        try:
+            self._executor.submit(self._scheduled_flush)
+        except RuntimeError:
+            # Pool already shut down (interpreter exit); write inline instead.
+            with self._start_lock:
+                self._flush_scheduled = False
+            self.flush()
 
+    def _scheduled_flush(self) -> None:
+        time.sleep(self.flush_interval)
+        with self._start_lock:
+            self._flush_scheduled = False
+        self.flush()
 
-def snapshot_state(snapshot_dir: Path, state: AgentState) -> None:
-    snapshot_dir.mkdir(parents=True, exist_ok=True)
-    path = snapshot_dir / f"state-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json"
-    path.write_text(json.dumps(state.to_dict(), indent=2))
+    def _run(self) -> None:
+        while True:
+            # Block until there is work, then give the batch a moment to fill up.
+            self._has_work.wait()
+            time.sleep(self.flush_interval)
+            self._has_work.clear()
+            self.flush()
@@ -1,55 +1,146 @@
 import os
+import gzip
+import asyncio
+import importlib.util
 import logging
 import json
+import queue
+import threading
 import time
-from flask import Flask, request, jsonify
+import uuid
+import zlib
+from concurrent.futures import Future
+from functools import lru_cache
+from flask import Blueprint, Flask, request, jsonify
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
+try:
+    from agent.quantization import quantization_kwargs
+except ImportError:
+    # Run as a script (python agent/<name>_server.py), so agent/ itself is on sys.path
+    from quantization import quantization_kwargs
+
+vllm_spec = importlib.util.find_spec("vllm")
+vllm_available = vllm_spec and vllm_spec.loader is not None
+if vllm_available:
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+else:
+    AsyncEngineArgs = AsyncLLMEngine = SamplingParams = None
+
+waitress_spec = importlib.util.find_spec("waitress")
+waitress_available = waitress_spec and waitress_spec.loader is not None
+if waitress_available:
+    import waitress
+else:
+    waitress = None
+
 # Configuration
 TEXT_MODEL = os.getenv("TEXT_MODEL", "Qwen/Qwen2.5-0.5B-Instruct")
 PORT = int(os.getenv("PORT", 11435))
 device = "cuda" if torch.cuda.is_available() else "cpu"
+# "auto" uses vLLM (continuous batching across concurrent requests) when it is
+# installed and a GPU is present; "transformers" forces the generate() micro-batcher.
+TEXT_ENGINE = os.getenv("TEXT_ENGINE", "auto").lower()
+VLLM_MAX_NUM_SEQS = int(os.getenv("VLLM_MAX_NUM_SEQS", 32))
+# Fraction of GPU memory vLLM may claim; the rest is left for Florence-2 in the same process
+VLLM_GPU_MEMORY_UTILIZATION = float(os.getenv("VLLM_GPU_MEMORY_UTILIZATION", 0.6))
+# ABSTERGO_COMPILE=1 compiles the transformers model's forward with TorchInductor
+COMPILE = os.getenv("ABSTERGO_COMPILE", "0") == "1"
+# transformers path: requests arriving within the window share one padded generate()
+BATCH_WINDOW = float(os.getenv("SERVER_BATCH_WINDOW_MS", 10)) / 1000.0
+MAX_BATCH = max(1, int(os.getenv("SERVER_MAX_BATCH", 8)))
+# Request threads; each one blocks on the batcher, so this bounds how many can share a batch
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 8))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Routes live on a blueprint so app.py can serve them in-process; running this
+# file directly serves them from a standalone app.
+bp = Blueprint("text_server", __name__)
 
 model = None
 tokenizer = None
+engine = None
+# vLLM's engine runs on its own asyncio loop; Flask request threads submit to it.
+_engine_loop = None
+# (input_ids, temperature, future) items for the transformers batch worker
+_batch_queue = queue.Queue()
+
+def _use_vllm():
+    if TEXT_ENGINE == "transformers":
+        return False
+    if TEXT_ENGINE == "vllm" and not vllm_available:
+        raise RuntimeError("TEXT_ENGINE=vllm but vllm is not installed")
+    return vllm_available and (TEXT_ENGINE == "vllm" or device == "cuda")
+
+def _start_engine():
+    global engine, _engine_loop
+    _engine_loop = asyncio.new_event_loop()
+    threading.Thread(target=_engine_loop.run_forever, name="vllm-engine", daemon=True).start()
+    args = AsyncEngineArgs(
+        model=TEXT_MODEL,
+        dtype="float16",
+        max_num_seqs=VLLM_MAX_NUM_SEQS,
+        gpu_memory_utilization=VLLM_GPU_MEMORY_UTILIZATION,
+        trust_remote_code=True,
+    )
+    engine = AsyncLLMEngine.from_engine_args(args)
 
 def load_model():
     global model, tokenizer
-    logger.info(f"Loading Text model: {TEXT_MODEL} on {device}...")
     try:
         tokenizer = AutoTokenizer.from_pretrained(TEXT_MODEL, trust_remote_code=True)
+        if _use_vllm():
+            logger.info(f"Loading Text model: {TEXT_MODEL} with vLLM (max_num_seqs={VLLM_MAX_NUM_SEQS})...")
+            _start_engine()
+            logger.info("Text model loaded successfully.")
+            return
+        logger.info(f"Loading Text model: {TEXT_MODEL} on {device}...")
+        quant_kwargs = quantization_kwargs(device)
         model = AutoModelForCausalLM.from_pretrained(
             TEXT_MODEL,
             trust_remote_code=True,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32
-        ).to(device)
+            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            **quant_kwargs
+        )
+        if not quant_kwargs:
+            # Quantized weights are placed by device_map and can't be moved
+            model = model.to(device)
+        if COMPILE:
+            _compile_model()
+        threading.Thread(target=_batch_worker, name="generate-batcher", daemon=True).start()
         logger.info("Text model loaded successfully.")
     except Exception as e:
         logger.error(f"Failed to load text model: {e}")
         raise e
 
-@app.route("/v1/chat/completions", methods=["POST"])
-def chat_completions():
-    if not request.json:
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    data = request.json
-    messages = data.get("messages", [])
-    temperature = data.get("temperature", 0.7)
+def _compile_model():
+    # A static KV cache keeps the cache shape fixed as decoding proceeds. Prompt width
+    # and micro-batch size still vary per request, so the graph is compiled with dynamic
+    # shapes; a static-shape (or CUDA-graph) compile would recompile for each new pair.
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(model.forward, dynamic=True)
+    logger.info("Compiling text model (warmup generate)...")
+    warmup_ids = tokenizer(["warmup"], return_tensors="pt").input_ids.to(device)
+    with torch.inference_mode():
+        model.generate(warmup_ids, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.eos_token_id)
 
-    if not messages:
-        return jsonify({"error": "No messages provided"}), 400
+def _request_json():
+    # Clients may gzip large prompt bodies (Content-Encoding: gzip); Flask doesn't inflate them itself.
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        try:
+            return json.loads(gzip.decompress(request.get_data()))
+        except (OSError, EOFError, zlib.error, ValueError):
+            # Corrupt or truncated gzip raises zlib.error / EOFError, not OSError
+            return None
+    return request.get_json(silent=True)
 
-    # Format prompt
+def _render_prompt(messages):
     # Simple formatting for chat models if apply_chat_template is available
     try:
-        text = tokenizer.apply_chat_template(
+        return tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
@@ -62,23 +153,114 @@ def chat_completions():
             content = msg.get("content", "")
             text += f"{role}: {content}\n"
         text += "assistant: "
+        return text
+
+@lru_cache(maxsize=512)
+def _tokenize(key):
+    # key is a tuple of (role, content) pairs; the returned tensor is shared
+    # between cache hits and must not be modified in place.
+    messages = [{"role": role, "content": content} for role, content in key]
+    input_ids = tokenizer([_render_prompt(messages)], return_tensors="pt").input_ids
+    # vLLM takes plain token ids, so only the transformers path needs them on the device
+    return input_ids if engine is not None else input_ids.to(device)
+
+async def _vllm_generate(prompt_ids, temperature):
+    params = SamplingParams(temperature=temperature, max_tokens=512)
+    final = None
+    async for output in engine.generate({"prompt_token_ids": prompt_ids}, params, request_id=uuid.uuid4().hex):
+        final = output
+    return final.outputs[0]
+
+def _generate(input_ids, temperature):
+    """Return (response_text, completion_token_count) for one prompt."""
+    if engine is not None:
+        future = asyncio.run_coroutine_threadsafe(
+            _vllm_generate(input_ids[0].tolist(), temperature), _engine_loop
+        )
+        completion = future.result()
+        return completion.text, len(completion.token_ids)
+
+    future = Future()
+    _batch_queue.put((input_ids, temperature, future))
+    return future.result()
+
+def _batch_worker():
+    while True:
+        batch = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Sampling settings apply to a whole generate() call, so batch per temperature
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[1], []).append(item)
+        for temperature, items in groups.items():
+            futures = [future for _, _, future in items]
+            try:
+                results = _generate_batch([input_ids for input_ids, _, _ in items], temperature)
+            except Exception as e:
+                logger.exception("Batched generate failed")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
 
-    inputs = tokenizer([text], return_tensors="pt").to(device)
+def _generate_batch(prompts, temperature):
+    """Left-pad the prompts into one batch and return (text, completion_tokens) per prompt."""
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(prompt.shape[1] for prompt in prompts)
+    input_ids = torch.full((len(prompts), width), pad_id, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((len(prompts), width), dtype=torch.long, device=device)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, width - prompt.shape[1]:] = prompt[0]
+        attention_mask[row, width - prompt.shape[1]:] = 1
 
-    # Generate
-    with torch.no_grad():
+    with torch.inference_mode():
         generated_ids = model.generate(
-            inputs.input_ids,
+            input_ids,
+            attention_mask=attention_mask,
             max_new_tokens=512,
             temperature=temperature,
             do_sample=True if temperature > 0 else False,
-            pad_token_id=tokenizer.eos_token_id
+            pad_token_id=pad_id,
+            use_cache=True
         )
 
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    response_text = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    results = []
+    for output_ids in generated_ids[:, width:]:
+        # Rows that finished early are padded out to the longest completion
+        completion_ids = output_ids[output_ids != pad_id]
+        results.append((tokenizer.decode(completion_ids, skip_special_tokens=True), len(completion_ids)))
+    return results
+
+@bp.route("/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    data = _request_json()
+    if not data:
+        return jsonify({"error": "Invalid JSON"}), 400
+
+    messages = data.get("messages", [])
+    temperature = data.get("temperature", 0.7)
+
+    if not messages:
+        return jsonify({"error": "No messages provided"}), 400
+
+    key = tuple((msg.get("role", "user"), msg.get("content", "")) for msg in messages)
+    try:
+        input_ids = _tokenize(key)
+    except TypeError:
+        # Unhashable content (e.g. a list of parts) bypasses the cache
+        input_ids = _tokenize.__wrapped__(key)
+
+    response_text, completion_tokens = _generate(input_ids, temperature)
 
     # OpenAI compatible response
     response = {
@@ -97,9 +279,9 @@ def chat_completions():
             }
         ],
         "usage": {
-            "prompt_tokens": len(inputs.input_ids[0]),
-            "completion_tokens": len(generated_ids[0]),
-            "total_tokens": len(inputs.input_ids[0]) + len(generated_ids[0])
+            "prompt_tokens": len(input_ids[0]),
+            "completion_tokens": completion_tokens,
+            "total_tokens": len(input_ids[0]) + completion_tokens
         }
     }
 
@@ -107,4 +289,9 @@ def chat_completions():
 
 if __name__ == "__main__":
     load_model()
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if waitress_available:
+        waitress.serve(app, host="0.0.0.0", port=PORT, threads=SERVER_THREADS)
+    else:
+        app.run(host="0.0.0.0", port=PORT, debug=False, threaded=True)
@@ -2,45 +2,128 @@ import os
 import json
 import logging
 import base64
+import importlib.util
 import io
+import queue
 import threading
-from typing import Dict, Any
+import time
+from concurrent.futures import Future
+from typing import Dict, Any, List, Tuple
 
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
 from PIL import Image
 import torch
 from transformers import AutoProcessor, AutoModelForCausalLM
 
+try:
+    from agent.quantization import quantization_kwargs
+except ImportError:
+    # Run as a script (python agent/<name>_server.py), so agent/ itself is on sys.path
+    from quantization import quantization_kwargs
+
+waitress_spec = importlib.util.find_spec("waitress")
+waitress_available = waitress_spec and waitress_spec.loader is not None
+if waitress_available:
+    import waitress
+else:
+    waitress = None
+
 # Configuration
 FLORENCE_MODEL = os.getenv("FLORENCE_MODEL", "microsoft/Florence-2-base")
 PORT = int(os.getenv("PORT", 8001))
 device = "cuda" if torch.cuda.is_available() else "cpu"
 torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+# ABSTERGO_COMPILE=1 compiles the vision encoder with TorchInductor
+COMPILE = os.getenv("ABSTERGO_COMPILE", "0") == "1"
+# Requests arriving within the window share one encoder pass and one generate()
+BATCH_WINDOW = float(os.getenv("SERVER_BATCH_WINDOW_MS", 10)) / 1000.0
+MAX_BATCH = max(1, int(os.getenv("SERVER_MAX_BATCH", 8)))
+# Request threads; each one blocks on the batcher, so this bounds how many can share a batch
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 8))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Routes live on a blueprint so app.py can serve them in-process; running this
+# file directly serves them from a standalone app.
+bp = Blueprint("vision_server", __name__)
 
 # Global model and processor
 model = None
 processor = None
 
+# Sub-tasks of the composite "detailed_scene" request, in response order
+SCENE_TASKS = ("<MORE_DETAILED_CAPTION>", "<DENSE_REGION_CAPTION>", "<OCR>")
+# Short task names clients may send instead of raw <TASK> prompts
+TASK_ALIASES = {
+    "caption": "<CAPTION>",
+    "detailed_caption": "<DETAILED_CAPTION>",
+    "more_detailed_caption": "<MORE_DETAILED_CAPTION>",
+    "ocr": "<OCR>",
+    "od": "<OD>",
+    "dense_region_caption": "<DENSE_REGION_CAPTION>"
+}
+# 1-D prompt token ids per task prompt; SCENE_TASKS are filled in by load_model.
+# Only these known prompts are cached: raw task strings come from clients, so
+# caching them too would grow without bound.
+CACHED_TASK_PROMPTS = frozenset(SCENE_TASKS) | frozenset(TASK_ALIASES.values())
+task_input_ids: Dict[str, torch.Tensor] = {}
+# (width, height) the image processor resizes to; set by load_model
+encoder_size = None
+# (image, task_prompts, future) items for the batch worker
+_batch_queue = queue.Queue()
+
 def load_model():
-    global model, processor
+    global model, processor, encoder_size
     logger.info(f"Loading Florence-2 model: {FLORENCE_MODEL} on {device}...")
     try:
+        quant_kwargs = quantization_kwargs(device)
         model = AutoModelForCausalLM.from_pretrained(
             FLORENCE_MODEL,
             trust_remote_code=True,
-            torch_dtype=torch_dtype
-        ).to(device)
+            torch_dtype=torch_dtype,
+            **quant_kwargs
+        )
+        if not quant_kwargs:
+            # Quantized weights are placed by device_map and can't be moved
+            model = model.to(device)
         processor = AutoProcessor.from_pretrained(FLORENCE_MODEL, trust_remote_code=True)
+        size = getattr(processor.image_processor, "size", None) or {}
+        if "width" in size and "height" in size:
+            encoder_size = (size["width"], size["height"])
+        for task_prompt in SCENE_TASKS:
+            _prompt_ids(task_prompt)
+        if COMPILE and hasattr(model, "_encode_image"):
+            _compile_encoder()
+        threading.Thread(target=_batch_worker, name="florence-batcher", daemon=True).start()
         logger.info("Model loaded successfully.")
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
         raise e
 
+def _decode_image(stream) -> Image.Image:
+    image = Image.open(stream)
+    source_size = image.size
+    # JPEGs are decoded at a reduced DCT scale when they are far larger than
+    # the encoder input (the processor resizes everything to that anyway);
+    # draft() is a no-op for other formats.
+    if encoder_size:
+        image.draft("RGB", encoder_size)
+    image = image.convert("RGB")
+    image.info["source_size"] = source_size
+    return image
+
+def _compile_encoder():
+    # The processor resizes every screenshot to the same resolution, but the batcher
+    # encodes 1..MAX_BATCH images at once; a dynamic-shape graph covers every batch
+    # size instead of recompiling for each one.
+    model._encode_image = torch.compile(model._encode_image, dynamic=True)
+    logger.info("Compiling vision encoder (warmup pass)...")
+    blank = Image.new("RGB", (64, 64))
+    pixel_values = processor.image_processor(blank, return_tensors="pt")["pixel_values"].to(device, torch_dtype)
+    with torch.inference_mode():
+        model._encode_image(pixel_values)
+
 def run_florence_task(image: Image.Image, task_prompt: str, text_input: str = None) -> Any:
     if model is None or processor is None:
         raise RuntimeError("Model not loaded")
@@ -51,24 +134,132 @@ def run_florence_task(image: Image.Image, task_prompt: str, text_input: str = No
 
     inputs = processor(text=prompt, images=image, return_tensors="pt").to(device, torch_dtype)
 
-    generated_ids = model.generate(
-        input_ids=inputs["input_ids"],
-        pixel_values=inputs["pixel_values"],
-        max_new_tokens=1024,
-        do_sample=False,
-        num_beams=3,
-    )
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            input_ids=inputs["input_ids"],
+            pixel_values=inputs["pixel_values"],
+            max_new_tokens=1024,
+            do_sample=False,
+            num_beams=3,
+        )
+
+    return _parse_generation(generated_ids, task_prompt, image)
+
+def _source_size(image: Image.Image) -> Tuple[int, int]:
+    # Size of the uploaded image before any reduced-size JPEG decode, so
+    # returned coordinates stay in the client's pixel space.
+    return image.info.get("source_size", image.size)
 
+def _parse_generation(generated_ids, task_prompt: str, image: Image.Image) -> Any:
     generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
     parsed_answer = processor.post_process_generation(
         generated_text,
         task=task_prompt,
-        image_size=(image.width, image.height)
+        image_size=_source_size(image)
     )
 
     return parsed_answer
 
-@app.route("/v1/vision", methods=["POST"])
+def _prompt_ids(task_prompt: str) -> torch.Tensor:
+    input_ids = task_input_ids.get(task_prompt)
+    if input_ids is None:
+        # Same prompt expansion the processor applies (e.g. "<OCR>" -> "What is the text in the image?")
+        construct = getattr(processor, "_construct_prompts", None)
+        text = construct([task_prompt])[0] if construct else task_prompt
+        tokens = processor.tokenizer(text, return_tensors="pt", return_token_type_ids=False)
+        input_ids = tokens["input_ids"][0].to(device)
+        if task_prompt in CACHED_TASK_PROMPTS:
+            task_input_ids[task_prompt] = input_ids
+    return input_ids
+
+def run_florence_tasks(image: Image.Image, task_prompts: Tuple[str, ...]) -> Dict[str, Any]:
+    """Run several task prompts on one image, batched with concurrent requests.
+
+    Requests queued within BATCH_WINDOW are served by one vision-encoder pass
+    and one generate() over every (image, prompt) pair.
+    """
+    if model is None or processor is None:
+        raise RuntimeError("Model not loaded")
+    if not hasattr(model, "_encode_image"):
+        return {task_prompt: run_florence_task(image, task_prompt) for task_prompt in task_prompts}
+
+    future = Future()
+    _batch_queue.put((image, task_prompts, future))
+    return future.result()
+
+def _batch_worker():
+    while True:
+        batch = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        futures = [future for _, _, future in batch]
+        try:
+            results = _run_batch([(image, task_prompts) for image, task_prompts, _ in batch])
+        except Exception as e:
+            logger.exception("Batched Florence-2 generate failed")
+            for future in futures:
+                future.set_exception(e)
+            continue
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+def _run_batch(requests: List[Tuple[Image.Image, Tuple[str, ...]]]) -> List[Dict[str, Any]]:
+    counts = [len(task_prompts) for _, task_prompts in requests]
+    prompts = [_prompt_ids(task_prompt) for _, task_prompts in requests for task_prompt in task_prompts]
+
+    # Right-pad the prompts (Florence-2's encoder reads image tokens, then the prompt)
+    pad_id = processor.tokenizer.pad_token_id
+    width = max(len(prompt) for prompt in prompts)
+    input_ids = torch.full((len(prompts), width), pad_id, dtype=torch.long, device=device)
+    text_mask = torch.zeros((len(prompts), width), dtype=torch.long, device=device)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, :len(prompt)] = prompt
+        text_mask[row, :len(prompt)] = 1
+
+    images = [image for image, _ in requests]
+    pixel_values = processor.image_processor(images, return_tensors="pt")["pixel_values"].to(device, torch_dtype)
+    with torch.inference_mode():
+        # One encoder pass per image, shared by all of that image's prompts
+        image_features = model._encode_image(pixel_values)
+        image_features = image_features.repeat_interleave(
+            torch.tensor(counts, device=image_features.device), dim=0
+        )
+        inputs_embeds = model.get_input_embeddings()(input_ids)
+        inputs_embeds, _ = model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+        attention_mask = torch.cat(
+            [text_mask.new_ones(image_features.shape[:2]), text_mask], dim=1
+        )
+        generated_ids = model.generate(
+            input_ids=input_ids,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            max_new_tokens=1024,
+            do_sample=False,
+            num_beams=3,
+        )
+
+    generated_texts = iter(processor.batch_decode(generated_ids, skip_special_tokens=False))
+    results = []
+    for image, task_prompts in requests:
+        results.append({
+            task_prompt: processor.post_process_generation(
+                next(generated_texts),
+                task=task_prompt,
+                image_size=_source_size(image)
+            )
+            for task_prompt in task_prompts
+        })
+    return results
+
+@bp.route("/v1/vision", methods=["POST"])
 def vision_endpoint():
     if "image" not in request.files:
         return jsonify({"error": "No image file provided"}), 400
@@ -83,7 +274,7 @@ def vision_endpoint():
     task = payload.get("parameters", {}).get("task", "detailed_scene")
 
     try:
-        image = Image.open(file.stream).convert("RGB")
+        image = _decode_image(file.stream)
     except Exception as e:
         return jsonify({"error": f"Invalid image: {e}"}), 400
 
@@ -93,19 +284,17 @@ def vision_endpoint():
         response_data = {}
 
         if task == "detailed_scene":
-            # Composite task for UI understanding
+            # Composite task for UI understanding; the three prompts share one encoder pass
+            scene = run_florence_tasks(image, SCENE_TASKS)
 
             # 1. High-level description
-            caption_result = run_florence_task(image, "<MORE_DETAILED_CAPTION>")
-            response_data["description"] = caption_result.get("<MORE_DETAILED_CAPTION>", "")
+            response_data["description"] = scene["<MORE_DETAILED_CAPTION>"].get("<MORE_DETAILED_CAPTION>", "")
 
             # 2. Dense Region Caption (UI elements)
-            drc_result = run_florence_task(image, "<DENSE_REGION_CAPTION>")
-            response_data["ui_elements"] = drc_result.get("<DENSE_REGION_CAPTION>", {})
+            response_data["ui_elements"] = scene["<DENSE_REGION_CAPTION>"].get("<DENSE_REGION_CAPTION>", {})
 
             # 3. OCR (Text detection) - Optional: might be slow, but useful
-            ocr_result = run_florence_task(image, "<OCR>")
-            response_data["detected_text"] = ocr_result.get("<OCR>", "")
+            response_data["detected_text"] = scene["<OCR>"].get("<OCR>", "")
 
             # 4. Object Detection (Generic) - Optional
             # od_result = run_florence_task(image, "<OD>")
@@ -116,20 +305,11 @@ def vision_endpoint():
             # Map "caption" -> <CAPTION>, etc. if needed, or assume raw task prompts
             if not task.startswith("<"):
                 # Simple mapping for common tasks if not provided in <> format
-                task_map = {
-                    "caption": "<CAPTION>",
-                    "detailed_caption": "<DETAILED_CAPTION>",
-                    "more_detailed_caption": "<MORE_DETAILED_CAPTION>",
-                    "ocr": "<OCR>",
-                    "od": "<OD>",
-                    "dense_region_caption": "<DENSE_REGION_CAPTION>"
-                }
-                florence_task = task_map.get(task, "<MORE_DETAILED_CAPTION>")
+                florence_task = TASK_ALIASES.get(task, "<MORE_DETAILED_CAPTION>")
             else:
                 florence_task = task
 
-            result = run_florence_task(image, florence_task)
-            response_data = result
+            response_data = run_florence_tasks(image, (florence_task,))[florence_task]
 
         return jsonify(response_data)
 
@@ -139,4 +319,9 @@ def vision_endpoint():
 
 if __name__ == "__main__":
     load_model()
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if waitress_available:
+        waitress.serve(app, host="0.0.0.0", port=PORT, threads=SERVER_THREADS)
+    else:
+        app.run(host="0.0.0.0", port=PORT, debug=False, threaded=True)
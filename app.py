@@ -1,23 +1,35 @@
 from __future__ import annotations
 
-import json
 import os
-import subprocess
-import sys
 import time
-import atexit
+import hashlib
+import importlib.util
 import logging
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Optional, Tuple
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
 
+from agent import fastjson
 from agent.loop import AgentOrchestrator
+from agent.storage import recent_log_json
+
+waitress_spec = importlib.util.find_spec("waitress")
+waitress_available = waitress_spec and waitress_spec.loader is not None
+if waitress_available:
+    import waitress
+else:
+    waitress = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# FLASK_DEBUG=1 runs the Werkzeug dev server with the reloader; otherwise waitress
+# (when installed) serves the UI polls and API calls from a thread pool.
+DEBUG = os.getenv("FLASK_DEBUG", "0") == "1"
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 8))
+
 
 DATA_DIR = Path("data")
 STATE_PATH = DATA_DIR / "state.json"
@@ -28,14 +40,37 @@ CORS(app)
 orchestrator = AgentOrchestrator(STATE_PATH, DATA_DIR)
 
 
+def json_response(payload: Any, status: int = 200) -> Response:
+    """jsonify() equivalent serialized with orjson (the UI polls these endpoints)."""
+
+    return Response(fastjson.dumps_bytes(payload), status=status, mimetype="application/json")
+
+
 @app.route("/")
 def index() -> Any:
     return send_from_directory(app.static_folder, "index.html")
 
 
+# (state version, monotonic time, body, etag). The body embeds time_since_last_action,
+# so it is reused for at most STATE_CACHE_TTL seconds even when the state is unchanged.
+STATE_CACHE_TTL = 1.0
+_state_cache: Tuple[int, float, bytes, str] = (-1, 0.0, b"", "")
+
+
 @app.route("/api/state", methods=["GET"])
 def api_state() -> Any:
-    return jsonify(orchestrator.get_state())
+    global _state_cache
+    version = orchestrator.state_manager.version
+    now = time.monotonic()
+    cached_version, built_at, body, etag = _state_cache
+    if cached_version != version or now - built_at >= STATE_CACHE_TTL:
+        body = fastjson.dumps_bytes(orchestrator.get_state())
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        _state_cache = (version, now, body, etag)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    # Answers If-None-Match with an empty 304 when the client already has this body.
+    return response.make_conditional(request)
 
 
 @app.route("/api/start", methods=["POST"])
@@ -46,13 +81,13 @@ def api_start() -> Any:
     active_start = payload.get("active_start")
     active_stop = payload.get("active_stop")
     orchestrator.start(mode, goal, active_start, active_stop)
-    return jsonify({"status": "started"})
+    return json_response({"status": "started"})
 
 
 @app.route("/api/stop", methods=["POST"])
 def api_stop() -> Any:
     orchestrator.stop()
-    return jsonify({"status": "stopped"})
+    return json_response({"status": "stopped"})
 
 
 @app.route("/api/config", methods=["POST"])
@@ -64,90 +99,56 @@ def api_config() -> Any:
     active_stop = payload.get("active_stop", orchestrator.state.active_window_stop)
     orchestrator.state_manager.set_goal(goal, mode)
     orchestrator.state_manager.set_active_window(active_start, active_stop)
-    return jsonify({"status": "updated", "state": orchestrator.get_state()})
+    return json_response({"status": "updated", "state": orchestrator.get_state()})
 
 
 @app.route("/api/logs", methods=["GET"])
 def api_logs() -> Any:
-    log_path = DATA_DIR / "actions.log"
-    if not log_path.exists():
-        return jsonify([])
-    lines = log_path.read_text().splitlines()[-50:]
-    return jsonify([json.loads(line) for line in lines])
+    return Response(recent_log_json(orchestrator.log_path), mimetype="application/json")
 
 
-def ensure_servers_running() -> List[subprocess.Popen]:
-    """Ensures that the vision and text servers are running if hybrid mode is enabled."""
+def mount_model_servers() -> None:
+    """Loads the hybrid backend's Florence-2 and text models into this process.
+
+    Their ``/v1/vision`` and ``/v1/chat/completions`` routes are registered on this
+    app, so both models share one CUDA context and are reached without a hop
+    through separate server processes.
+    """
     backend = os.getenv("PLANNER_BACKEND", "gemini").lower()
     if backend != "hybrid":
-        return []
-
-    logger.info("Hybrid backend detected. Ensuring model servers are running...")
-    processes = []
-
-    # Check/Start Vision Server
-    vision_port = 8001
-    # Very basic check: just see if we can connect or if we assume they aren't running
-    # For this implementation, we will try to spawn them.
-    # Ideally, we should check if the port is in use.
-
-    env = os.environ.copy()
-
-    # Start Vision Server
-    logger.info(f"Starting Vision Server on port {vision_port}...")
-    vision_proc = subprocess.Popen(
-        [sys.executable, "agent/vision_server.py"],
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    processes.append(vision_proc)
-
-    # Start Text Server
-    text_port = 11435
-    logger.info(f"Starting Text Server on port {text_port}...")
-    text_proc = subprocess.Popen(
-        [sys.executable, "agent/text_server.py"],
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    processes.append(text_proc)
-
-    # Give them a moment to start
-    time.sleep(5)
-
-    # check if they died immediately
-    if vision_proc.poll() is not None:
-        out, err = vision_proc.communicate()
-        logger.error(f"Vision server failed to start: {err.decode()}")
-
-    if text_proc.poll() is not None:
-        out, err = text_proc.communicate()
-        logger.error(f"Text server failed to start: {err.decode()}")
-
-    return processes
+        return
+
+    # Imported here: they pull in torch/transformers, which the other backends don't need.
+    try:
+        from agent import text_server, vision_server
+    except ImportError:
+        logger.exception("Model servers unavailable (torch/transformers missing?)")
+        return
+
+    logger.info("Hybrid backend detected. Loading model servers in-process...")
+    # A model that fails to load only loses its routes; the UI and the agent keep
+    # running (the planner WAITs until vision/text calls succeed).
+    for server, url_env in ((vision_server, "FLORENCE_BASE_URL"), (text_server, "TEXT_BASE_URL")):
+        if os.getenv(url_env):
+            # The planner was pointed at an external server; a local copy would go unused.
+            logger.info("%s is set; not loading %s in-process", url_env, server.__name__)
+            continue
+        try:
+            server.load_model()
+        except Exception:
+            logger.exception("Failed to load %s; its endpoint will not be served", server.__name__)
+            continue
+        app.register_blueprint(server.bp)
 
 
 if __name__ == "__main__":
-    server_procs = []
-    # Only start servers if not in reloader (Flask debug mode spawns two processes)
+    app.debug = DEBUG
+    # Only load models if not in reloader (Flask debug mode spawns two processes)
     if os.environ.get("WERKZEUG_RUN_MAIN") == "true" or not app.debug:
-        server_procs = ensure_servers_running()
+        mount_model_servers()
 
-    def cleanup():
-        for proc in server_procs:
-            if proc.poll() is None:
-                logger.info(f"Terminating subprocess {proc.pid}...")
-                proc.terminate()
-                try:
-                    proc.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    proc.kill()
-
-    atexit.register(cleanup)
-
-    try:
-        app.run(host="0.0.0.0", port=8000, debug=True)
-    finally:
-        cleanup()
+    if waitress_available and not DEBUG:
+        # Single process on purpose: the orchestrator and its loop thread live here.
+        waitress.serve(app, host="0.0.0.0", port=8000, threads=SERVER_THREADS)
+    else:
+        app.run(host="0.0.0.0", port=8000, debug=DEBUG, threaded=True)